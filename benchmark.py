@@ -0,0 +1,262 @@
+#!/usr/bin/python
+
+# benchmark.py: timing suite for Nostradamus and the tracking tick
+# Written for UCLA's ELFIN mission <elfin.igpp.ucla.edu>
+
+# Runs every Predictor API and a full tracker tick against synthetic TLE
+# catalogs (1 satellite up to an active-catalog sized file) and fake
+# rotctld/GQRX endpoints on localhost. Results can be saved as JSON and
+# compared against an earlier run:
+#
+#   ./benchmark.py --save before.json
+#   ./benchmark.py --compare before.json
+
+import argparse
+import datetime
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import nostradamus
+import pathplan
+
+CATALOG_SIZES = [1, 100, 3000]
+SWITCH_SIZES  = [1, 10, 50]
+TRACK_SAMPLES = 86400
+REPEAT        = 2000
+REGRESSION    = 1.2 # flag benchmarks that got this much slower
+
+###############################################################################
+def _checksum(line):
+    total = 0
+    for c in line[:68]:
+        if c.isdigit():
+            total += int(c)
+        elif c == '-':
+            total += 1
+    return line[:68] + str(total % 10)
+
+def fixtureTLEs(count, epoch=None):
+    '''Returns a deterministic catalog of count LEO element sets. Only the
+       epoch moves, to the start of today, so runs on different days do
+       the same propagation work.
+    '''
+    if epoch is None:
+        epoch = datetime.datetime.utcnow()
+    day = epoch.timetuple().tm_yday
+    lines = []
+    for i in range(count):
+        norad = 40000 + i
+        line1 = ("1 %05dU 15%03d%-3s %02d%03d.00000000  .00002881  00000-0"
+                 "  12567-3 0  999" % (norad, 1 + i // 26, chr(65 + i % 26),
+                                       epoch.year % 100, day))
+        line2 = ("2 %05d %8.4f %8.4f 0013505 260.9054 %8.4f %11.8f13564"
+                 % (norad, 97.0 + (i % 20) * 0.5, (28.87 + i * 37.1) % 360,
+                    (97.68 + i * 53.3) % 360, 14.5 + (i % 10) * 0.12))
+        lines += ["BENCHSAT %d" % i, _checksum(line1), _checksum(line2)]
+    return "\n".join(lines) + "\n"
+
+###############################################################################
+class FakeEndpoint(object):
+    '''Line-based TCP stand-in for rotctld or GQRX. Answers "P"/"F" with
+       RPRT 0, "p" with a position and "f" with the last frequency.
+    '''
+    def __init__(self):
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        self.value = '0'
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        while True:
+            conn, addr = self.sock.accept()
+            thread = threading.Thread(target=self._serve, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, conn):
+        buf = ''
+        while True:
+            data = conn.recv(1024)
+            if not data:
+                return
+            buf += data
+            while '\n' in buf:
+                line, buf = buf.split('\n', 1)
+                if line[:1] in ('P', 'F'):
+                    self.value = line.split()[1]
+                    conn.sendall('RPRT 0\n')
+                elif line[:1] == 'p':
+                    conn.sendall('%s\n0.000000\n' % self.value)
+                elif line[:1] == 'f':
+                    conn.sendall('%s\n' % self.value)
+                elif line[:1] == 'q':
+                    conn.close()
+                    return
+                else:
+                    conn.sendall('RPRT -1\n')
+
+###############################################################################
+def measure(name, func, repeat=REPEAT, items=1):
+    '''Calls func repeat times and returns a result dict with latency
+       percentiles (microseconds) and throughput (items per second)
+    '''
+    samples = []
+    for i in range(repeat):
+        start = time.time()
+        func(i)
+        samples.append(time.time() - start)
+    samples.sort()
+    def pct(p):
+        return samples[min(int(p / 100.0 * len(samples)), len(samples) - 1)] * 1e6
+    total = sum(samples)
+    return {"name": name, "calls": repeat,
+            "p50_us": pct(50), "p90_us": pct(90), "p99_us": pct(99),
+            "max_us": samples[-1] * 1e6,
+            "per_sec": repeat * items / total if total else float('inf')}
+
+def predictorBenchmarks(workdir, repeat):
+    results = []
+    now = time.time()
+    for size in CATALOG_SIZES:
+        with open(os.path.join(workdir, "tle.txt"), 'w') as f:
+            f.write(fixtureTLEs(size))
+        last = "BENCHSAT %d" % (size - 1)
+
+        def cold(i):
+            nostradamus.Predictor().loadTLE(last)
+        results.append(measure("loadTLE cold, %d sats" % size, cold,
+                               max(repeat // 100, 5)))
+        n = nostradamus.Predictor()
+        results.append(measure("loadTLE, %d sats" % size,
+                               lambda i: n.loadTLE(last), repeat))
+        results.append(measure("printTLE, %d sats" % size,
+                               lambda i: n.printTLE(last), repeat))
+
+    n = nostradamus.Predictor()
+    n.addSatellite("BENCHSAT 0")
+    sat = "BENCHSAT 0"
+    for api in ("position", "velocity", "azimuth", "elevation", "state"):
+        call = getattr(n, api)
+        results.append(measure(api, lambda i: call(sat, now + i), repeat))
+    results.append(measure("nextpass", lambda i: n.nextpass(sat, now + i),
+                           repeat))
+    results.append(measure("nextpass uncached", lambda i: (
+        n._passes.clear(), n.nextpass(sat, now + i)), max(repeat // 20, 5)))
+    if nostradamus.numpy is not None:
+        times = nostradamus.numpy.arange(now, now + TRACK_SAMPLES, 1.0)
+        results.append(measure("track, %d samples" % TRACK_SAMPLES,
+                               lambda i: n.track(sat, times), 3,
+                               TRACK_SAMPLES))
+        traj = n.trajectory(sat, now)
+        results.append(measure("trajectory lookup",
+                               lambda i: traj.at(traj.start + i % traj.size),
+                               repeat))
+        results.append(measure("plan pass, %d samples" % traj.size,
+                               lambda i: pathplan.planPass(traj), 3,
+                               traj.size))
+    for size in SWITCH_SIZES:
+        m = nostradamus.Predictor()
+        for i in range(size):
+            m.addSatellite("BENCHSAT %d" % i)
+        results.append(measure("snapshot_all, %d sats" % size,
+                               lambda i: m.snapshot_all(now + i), repeat // 10,
+                               size))
+    return results
+
+def tickBenchmark(repeat):
+    '''Times predict, both rotor axes and the Doppler update of one tracker
+       tick. In-pass I/O is forced so every tick talks to the endpoints.
+    '''
+    import satellite_tracker as st
+    az_end, el_end, rig_end = FakeEndpoint(), FakeEndpoint(), FakeEndpoint()
+    st.az_axis = st.RotorAxis("AZ", st.RotctldClient(st.LOCALHOST,
+                                                     az_end.port),
+                              deadband=0, min_interval=0)
+    st.el_axis = st.RotorAxis("EL", st.RotctldClient(st.LOCALHOST,
+                                                     el_end.port),
+                              deadband=0, min_interval=0)
+    st.rotors = st.RotorPair(st.az_axis, st.el_axis)
+    st.r = st.RadioControl(port=rig_end.port)
+    st.doppler = st.DopplerCorrector(st.r, threshold=0)
+    st.n = nostradamus.Predictor()
+    st.satellite = "BENCHSAT 0"
+    st.satellite_list = [st.satellite]
+    st.frequency_list = [437000000]
+    st.selection = 'P'
+    st.vel = 0
+    st.n.addSatellite(st.satellite)
+    st.update_plan()
+
+    def tick(i):
+        st.predict_tick()
+        st.IN_RANGE = True
+        st.track_axis(st.az_axis, 0)
+        st.track_axis(st.el_axis, 1)
+        st.doppler_tick()
+    return [measure("tracking tick", tick, repeat // 10)]
+
+###############################################################################
+def report(results, baseline=None):
+    base = {}
+    if baseline:
+        base = dict((r["name"], r) for r in baseline["results"])
+    print("%-32s %10s %10s %10s %10s %12s" % ("benchmark", "p50 us", "p90 us",
+                                              "p99 us", "max us", "per sec"))
+    for r in results:
+        line = "%-32s %10.1f %10.1f %10.1f %10.1f %12.0f" % (
+            r["name"], r["p50_us"], r["p90_us"], r["p99_us"], r["max_us"],
+            r["per_sec"])
+        old = base.get(r["name"])
+        if old and old["p50_us"]:
+            ratio = r["p50_us"] / old["p50_us"]
+            line += "  x%.2f" % ratio
+            if ratio > REGRESSION:
+                line += " REGRESSION"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Nostradamus benchmarks")
+    parser.add_argument("--save", help="write results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of an earlier run")
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("--no-tick", action="store_true",
+                        help="skip the tracking tick benchmark")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="nostradamus-bench")
+    os.chdir(workdir)
+    try:
+        results = predictorBenchmarks(workdir, args.repeat)
+        if not args.no_tick:
+            with open("tle.txt", 'w') as f:
+                f.write(fixtureTLEs(1))
+            results += tickBenchmark(args.repeat)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+    report(results, baseline)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({"when": time.time(), "python": sys.version,
+                       "results": results}, f, indent=1)
+
+if __name__ == "__main__":
+    main()
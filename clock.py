@@ -0,0 +1,115 @@
+# clock.py: the time the tracker runs on, wall clock or simulated
+# Written for UCLA's ELFIN mission <elfin.igpp.ucla.edu>
+
+# Prediction, scheduling, rotor pacing and the engine read the time through
+# this module instead of time.time(), so a whole tracking run can be moved
+# onto simulated time:
+#
+#   clock.use(clock.ScaledClock(start, rate=100)) # 100x faster than real
+#   clock.use(clock.SteppedClock(start))          # as fast as it computes
+#
+# Network timeouts, reconnect backoff and instrumentation stay on the wall
+# clock; they measure the host, not the pass.
+
+import datetime
+import threading
+import time
+
+################################################################################
+class Clock(object):
+    '''The wall clock'''
+    rate    = 1.0
+    stepped = False
+
+    def now(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def wait(self, event, timeout):
+        '''event.wait(timeout) with timeout in clock seconds'''
+        return event.wait(timeout)
+
+class ScaledClock(Clock):
+    '''Simulated time starting at start (unix time, default now) and running
+       rate times faster than the wall clock. Sleeps and waits are shortened
+       to match, so threads keep their cadence relative to each other.
+    '''
+    def __init__(self, start=None, rate=100.0):
+        self.origin = time.time()
+        self.start  = self.origin if start is None else start
+        self.rate   = float(rate)
+
+    def now(self):
+        return self.start + (time.time() - self.origin) * self.rate
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds / self.rate)
+
+    def wait(self, event, timeout):
+        if timeout is not None:
+            timeout = max(timeout, 0) / self.rate
+        return event.wait(timeout)
+
+class SteppedClock(Clock):
+    '''Simulated time that only moves when advanced. The engine advances it
+       to the next due task, so a run takes exactly as long as its compute.
+       Sleeps and waits block until the clock has been advanced past them.
+    '''
+    rate    = None
+    stepped = True
+    POLL    = 0.05 # wall seconds between event checks while waiting
+
+    def __init__(self, start=None):
+        self._now  = time.time() if start is None else float(start)
+        self._cond = threading.Condition()
+
+    def now(self):
+        return self._now
+
+    def advance(self, to):
+        '''Moves the clock forward to unix time to, never back'''
+        with self._cond:
+            if to > self._now:
+                self._now = to
+                self._cond.notify_all()
+
+    def sleep(self, seconds):
+        self.wait(None, seconds)
+
+    def wait(self, event, timeout):
+        deadline = None if timeout is None else self._now + max(timeout, 0)
+        with self._cond:
+            while event is None or not event.is_set():
+                if deadline is not None and self._now >= deadline:
+                    return False
+                self._cond.wait(self.POLL)
+        return True
+
+################################################################################
+_clock = Clock()
+
+def use(new):
+    '''Switches every module over to clock new. Call before starting'''
+    global _clock
+    _clock = new
+    return new
+
+def get():
+    return _clock
+
+def now():
+    return _clock.now()
+
+def utcnow():
+    '''datetime.datetime.utcnow() on the current clock'''
+    return datetime.datetime.utcfromtimestamp(_clock.now())
+
+def sleep(seconds):
+    _clock.sleep(seconds)
+
+def wait(event, timeout):
+    return _clock.wait(event, timeout)
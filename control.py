@@ -0,0 +1,124 @@
+#!/usr/bin/python
+
+# control.py: JSON control socket for running the tracker headless
+# Written for UCLA's ELFIN mission <elfin.igpp.ucla.edu>
+
+# Requests and replies are one JSON object per line over a local Unix
+# socket. A request names a command and its arguments,
+#
+#   {"cmd": "add", "satellite": "FIREBIRD 4", "frequency": 437219000}
+#
+# and is answered with {"ok": true, ...} or {"ok": false, "error": "..."}.
+# Clients may keep a connection open and send any number of requests. From
+# a shell:
+#
+#   ./control.py state
+#   ./control.py add satellite="FIREBIRD 4" frequency=437219000
+#   ./control.py engage
+
+import json
+import os
+import socket
+import SocketServer
+import sys
+
+CONTROL_SOCKET = "/tmp/nostradamus.sock"
+CONTROL_TIMEOUT = 30 # seconds a client waits for one reply
+NAME_ARGS = ("satellite", "antenna") # always strings, e.g. satellite=40003
+
+class ControlError(Exception):
+    '''Raised by a command to reject a request'''
+    pass
+
+################################################################################
+class _Handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            if not line.strip():
+                continue
+            self.wfile.write(self.server.dispatch(line) + "\n")
+            self.wfile.flush()
+
+class ControlServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    '''Serves commands, a dict of name -> func(args) returning a dict of
+       reply fields, on a Unix socket. Each client gets its own thread;
+       commands must do their own locking.
+    '''
+    daemon_threads = True
+    request_queue_size = 64
+
+    def __init__(self, commands, path=CONTROL_SOCKET):
+        self.commands = commands
+        self.path     = path
+        if os.path.exists(path):
+            # stale socket left by a tracker that did not shut down cleanly
+            os.unlink(path)
+        SocketServer.UnixStreamServer.__init__(self, path, _Handler)
+        os.chmod(path, 0660)
+
+    def dispatch(self, line):
+        '''Runs one request line, returns the reply line'''
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ControlError("request must be a JSON object")
+            args = dict(request)
+            name = args.pop("cmd", None)
+            if name not in self.commands:
+                raise ControlError("unknown command %r, expected one of %s"
+                                   % (name, ", ".join(sorted(self.commands))))
+            reply = {"ok": True}
+            reply.update(self.commands[name](args) or {})
+        except ControlError as e:
+            reply = {"ok": False, "error": str(e)}
+        except ValueError as e:
+            reply = {"ok": False, "error": "bad request: %s" % e}
+        except Exception as e:
+            reply = {"ok": False, "error": "%s: %s" % (type(e).__name__, e)}
+        return json.dumps(reply)
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+################################################################################
+def request(cmd, path=CONTROL_SOCKET, timeout=CONTROL_TIMEOUT, **args):
+    '''Sends one command to a running tracker and returns the reply dict'''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        args["cmd"] = cmd
+        sock.sendall(json.dumps(args) + "\n")
+        reply = sock.makefile().readline()
+    finally:
+        sock.close()
+    if not reply:
+        raise socket.error("tracker closed the control socket")
+    return json.loads(reply)
+
+def _value(text):
+    '''Command line argument values are JSON if they parse, else strings'''
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+def main():
+    if len(sys.argv) < 2:
+        sys.exit("usage: %s command [name=value ...]" % sys.argv[0])
+    args = {}
+    for arg in sys.argv[2:]:
+        key, sep, value = arg.partition("=")
+        if not sep:
+            sys.exit("arguments are name=value, got %r" % arg)
+        args[key] = value if key in NAME_ARGS else _value(value)
+    reply = request(sys.argv[1], **args)
+    print(json.dumps(reply, indent=1, sort_keys=True))
+    if not reply.get("ok"):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+# doppler.py: Doppler correction for the downlink receiver and uplink rig
+# Written for UCLA's ELFIN mission <elfin.igpp.ucla.edu>
+
+import metrics
+from engine import log
+
+LIGHT_SPEED       = 299792.458 # km/s
+DOPPLER_THRESHOLD = 10         # Hz, smaller corrections are not sent
+
+def downlinkShift(freq, range_rate):
+    '''Returns the received frequency of a freq transmitter moving away at
+       range_rate km/s
+    '''
+    return freq * (1 - range_rate / LIGHT_SPEED)
+
+def uplinkShift(freq, range_rate):
+    '''Returns the frequency to transmit so the satellite receives freq'''
+    return freq / (1 - range_rate / LIGHT_SPEED)
+
+################################################################################
+class DopplerCorrector(object):
+    '''Retunes the downlink radio, and the uplink radio if there is one, for
+       the current range rate. Retunes smaller than threshold Hz are skipped
+       so a high update rate does not flood the rigs.
+    '''
+    def __init__(self, downlink_radio, uplink_radio=None,
+                 threshold=DOPPLER_THRESHOLD):
+        self.downlink_radio = downlink_radio
+        self.uplink_radio   = uplink_radio
+        self.threshold      = threshold
+        self.downlink       = None # last frequencies the rigs accepted, Hz
+        self.uplink         = None
+        self.retunes        = 0
+        self.skipped        = 0
+
+    def update(self, downlink, uplink, range_rate):
+        '''Tunes for nominal downlink/uplink frequencies in Hz (either may be
+           None) at range_rate km/s. Returns the corrected (downlink, uplink).
+        '''
+        if downlink:
+            freq = int(round(downlinkShift(downlink, range_rate)))
+            self.downlink = self._tune(self.downlink_radio, self.downlink, freq)
+        if uplink:
+            freq = int(round(uplinkShift(uplink, range_rate)))
+            self.uplink = self._tune(self.uplink_radio, self.uplink, freq)
+        return (self.downlink, self.uplink)
+
+    def _tune(self, radio, last, freq):
+        if last is not None and abs(freq - last) < self.threshold:
+            self.skipped += 1
+            metrics.inc("doppler_skipped_total")
+            return last
+        if radio is None:
+            return last
+        # only a frequency the rig accepted counts as tuned
+        reply = radio.set_frequency(freq)
+        if reply != "RPRT 0":
+            metrics.inc("doppler_errors_total")
+            log("doppler %d" % radio.port, "rigctl on port %d rejected F %d: %s"
+                % (radio.port, freq, reply))
+            return last
+        self.retunes += 1
+        metrics.inc("doppler_retunes_total")
+        return freq
@@ -0,0 +1,133 @@
+# engine.py: runs the tracker's jobs concurrently, each on its own cadence
+# Written for UCLA's ELFIN mission <elfin.igpp.ucla.edu>
+
+import threading
+import time
+import clock
+import metrics
+
+LOG_PERIOD = 10 # seconds between repeats of one console message
+TASK_JOIN  = 2  # seconds wait() gives each task to finish once stopped
+
+_logged = {} # key -> [time last printed, repeats held back since]
+_logLock = threading.Lock()
+
+def log(key, message, period=LOG_PERIOD):
+    '''Prints message, unless a message with the same key was printed less
+       than period seconds ago. Those are counted instead, so a fault that
+       repeats every tick cannot flood a slow console.
+    '''
+    now = time.time()
+    with _logLock:
+        entry = _logged.setdefault(key, [None, 0])
+        if entry[0] is not None and now - entry[0] < period:
+            entry[1] += 1
+            return False
+        held, entry[0], entry[1] = entry[1], now, 0
+    if held:
+        message += " (repeated %d times)" % held
+    print(message)
+    return True
+
+################################################################################
+class PeriodicTask(threading.Thread):
+    '''Calls func every period seconds on its own thread until the engine
+       stops. A slow or failing call only delays its own task; an overrun
+       skips ahead instead of firing a burst of catch-up calls. Periods are
+       on the clock module's time; busy is the wall time spent in func.
+    '''
+    def __init__(self, name, func, period, stopped):
+        threading.Thread.__init__(self, name=name)
+        self.daemon    = True
+        self.func      = func
+        self.period    = period
+        self.stopped   = stopped
+        self.runs      = 0
+        self.errors    = 0
+        self.lastError = None
+        self.busy      = 0.0
+        self.due       = None # next run, for a stepped engine
+
+    def runOnce(self):
+        start = time.time()
+        try:
+            self.func()
+        except Exception as e:
+            self.errors   += 1
+            self.lastError = e
+            metrics.inc("task_errors_total", task=self.name)
+            log(self.name, "%s task failed: %s" % (self.name, e))
+        self.runs += 1
+        self.busy += time.time() - start
+
+    def run(self):
+        deadline = clock.now()
+        while not self.stopped.is_set():
+            self.runOnce()
+            deadline += self.period
+            delay = deadline - clock.now()
+            if delay < 0:
+                deadline = clock.now()
+                delay    = 0
+            clock.wait(self.stopped, delay)
+
+################################################################################
+class Engine(object):
+    '''Owns a set of named tasks and stops them together. On a stepped
+       clock the periodic tasks do not get threads: wait() runs them one
+       at a time in due order, advancing the clock to each.
+    '''
+    def __init__(self):
+        self.stopped = threading.Event()
+        self.tasks   = {}
+
+    def every(self, name, period, func):
+        '''Runs func every period seconds on its own thread'''
+        self.tasks[name] = PeriodicTask(name, func, period, self.stopped)
+        return self.tasks[name]
+
+    def spawn(self, name, func):
+        '''Runs func once on its own thread, e.g. a blocking input loop'''
+        task = threading.Thread(target=func, name=name)
+        task.daemon = True
+        self.tasks[name] = task
+        return task
+
+    def start(self):
+        stepped = clock.get().stepped
+        for task in self.tasks.values():
+            if stepped and isinstance(task, PeriodicTask):
+                task.due = clock.now()
+            else:
+                task.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def running(self):
+        return not self.stopped.is_set()
+
+    def wait(self):
+        '''Blocks until stop(). Polls so Ctrl-C still reaches the main thread'''
+        if clock.get().stepped:
+            return self._step()
+        while not self.stopped.is_set():
+            self.stopped.wait(0.5)
+        # let calls in flight finish so nothing talks to the hardware after
+        for task in self.tasks.values():
+            if isinstance(task, PeriodicTask) and task.is_alive():
+                task.join(TASK_JOIN)
+
+    def _step(self):
+        tasks = [t for t in self.tasks.values() if isinstance(t, PeriodicTask)]
+        while tasks and not self.stopped.is_set():
+            task = min(tasks, key=lambda t: t.due)
+            clock.get().advance(task.due)
+            task.runOnce()
+            task.due += task.period
+
+    def budget(self):
+        '''Returns {task: (runs, mean wall seconds per run)}'''
+        return dict((name, (t.runs, t.busy / t.runs if t.runs else 0.0))
+                    for name, t in self.tasks.items()
+                    if isinstance(t, PeriodicTask))
@@ -0,0 +1,387 @@
+#!/usr/bin/python
+
+# ephemeris.py: precomputed, memory-mapped ephemerides shared between processes
+# Written for UCLA's ELFIN mission <elfin.igpp.ucla.edu>
+
+# One writer propagates every satellite in the TLE catalog over the next
+# hours into a fixed-layout binary file; any number of readers (tracker,
+# status display, logger) map it read-only and interpolate instead of
+# propagating themselves:
+#
+#   ./ephemeris.py                       # keep ephemeris.bin current
+#   ./ephemeris.py --show "CUBESAT 221"  # read it back
+#
+# Layout, little endian:
+#
+#   header     HEADER_SIZE bytes, see HEADER below
+#   directory  count entries of DIRECTORY: name, NORAD number, TLE epoch
+#              (unix) and the md5 of the two element lines
+#   data       float32 [count][samples][az, el, range, range rate] from
+#              DATA_ALIGN bytes on; az/el in degrees, range in km, range rate
+#              in km/s, NaN where sgp4 failed
+#
+# Sample k of every satellite is at start + k * step. The writer replaces
+# the file with a rename, so readers never see a half-written file and
+# pick up the new one on their next refresh.
+
+import argparse
+import hashlib
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+import nostradamus
+
+if nostradamus.numpy is None:
+    raise ImportError("ephemeris requires numpy and sgp4")
+import numpy
+
+EPHEMERIS_FILE = "ephemeris.bin"
+HOURS        = 6    # hours ahead covered by the file
+STEP         = 10   # seconds between samples
+ROLL_PERIOD  = 600  # seconds between moving the window forward
+POLL_PERIOD  = 60   # seconds between checks for a new tle.txt
+CHECK_PERIOD = 1.0  # seconds between a reader's checks for a new file
+
+MAGIC   = "NSEPHEM1"
+VERSION = 1
+# magic, version, count, samples, fields, start, step, lat, lon, elevation,
+# station name
+HEADER      = struct.Struct("<8sIIIIddddd32s")
+HEADER_SIZE = 128
+DIRECTORY   = numpy.dtype([("name", "S24"), ("norad", "<u4"),
+                           ("epoch", "<f8"), ("digest", "S16")])
+FIELDS      = len(nostradamus.Track._fields)
+DATA_ALIGN  = 4096
+
+def _dataOffset(count):
+    size = HEADER_SIZE + count * DIRECTORY.itemsize
+    return (size + DATA_ALIGN - 1) // DATA_ALIGN * DATA_ALIGN
+
+def _digest(entry):
+    return hashlib.md5(entry[1].strip() + entry[2].strip()).digest()
+
+################################################################################
+class EphemerisFile(object):
+    '''Read-only view of an ephemeris file. Lookups interpolate linearly
+       between samples, az across 0/360. The file is mapped, not read, so
+       every process on the host shares the same pages.
+    '''
+    def __init__(self, path=EPHEMERIS_FILE):
+        self.path   = path
+        self._stat  = None
+        self._check = 0
+        self.data   = None
+        self._open()
+
+    def _open(self):
+        st = os.stat(self.path)
+        with open(self.path, 'rb') as f:
+            header = HEADER.unpack(f.read(HEADER.size))
+        (magic, version, count, samples, fields, start, step, lat, lon,
+         elevation, station) = header
+        if magic != MAGIC or version != VERSION or fields != FIELDS:
+            raise ValueError("%s is not a version %d ephemeris file"
+                             % (self.path, VERSION))
+        self.count    = count
+        self.samples  = samples
+        self.start    = start
+        self.step     = step
+        self.location = (lat, lon, elevation)
+        self.station  = station.rstrip("\0")
+        self.directory = numpy.memmap(self.path, DIRECTORY, 'r', HEADER_SIZE,
+                                      (count,))
+        self.data = numpy.memmap(self.path, numpy.float32, 'r',
+                                 _dataOffset(count), (count, samples, FIELDS))
+        self._rows = {}
+        for row, entry in enumerate(self.directory):
+            # first occurrence wins, same as TLECatalog
+            self._rows.setdefault(entry["name"].strip(), row)
+            self._rows.setdefault(int(entry["norad"]), row)
+        self._stat = (st.st_ino, st.st_mtime, st.st_size)
+
+    def refresh(self, force=False):
+        '''Remaps the file if the writer replaced it. Returns True if so.
+           Unless forced, checks at most every CHECK_PERIOD seconds.
+        '''
+        now = time.time()
+        if not force and now - self._check < CHECK_PERIOD:
+            return False
+        self._check = now
+        st = os.stat(self.path)
+        if (st.st_ino, st.st_mtime, st.st_size) == self._stat:
+            return False
+        self._open()
+        return True
+
+    @property
+    def end(self):
+        return self.start + (self.samples - 1) * self.step
+
+    def covers(self, date):
+        return self.start <= date <= self.end
+
+    def names(self):
+        return [entry["name"].strip() for entry in self.directory]
+
+    def row(self, key):
+        '''Returns the row of a satellite name or NORAD number, or None'''
+        return self._rows.get(key)
+
+    def _index(self, date):
+        x = (date - self.start) / self.step
+        i = min(max(int(x), 0), self.samples - 2)
+        return i, min(max(x - i, 0.0), 1.0)
+
+    def at(self, key, date=None):
+        '''Returns an interpolated Track of floats for one satellite, or None
+           if it is not in the file or date is outside the window
+        '''
+        self.refresh()
+        if date is None:
+            date = time.time()
+        row = self.row(key)
+        if row is None or not self.covers(date) or self.samples < 2:
+            return None
+        i, f = self._index(date)
+        a, b = self.data[row, i].tolist(), self.data[row, i + 1].tolist()
+        daz = (b[0] - a[0] + 180.0) % 360.0 - 180.0
+        return nostradamus.Track((a[0] + f * daz) % 360.0,
+                                 a[1] + f * (b[1] - a[1]),
+                                 a[2] + f * (b[2] - a[2]),
+                                 a[3] + f * (b[3] - a[3]))
+
+    def snapshot(self, date=None, rows=None):
+        '''Returns a Track of arrays for every satellite (or the given rows)
+           at date, None outside the window
+        '''
+        self.refresh()
+        if date is None:
+            date = time.time()
+        if not self.covers(date) or self.samples < 2:
+            return None
+        i, f = self._index(date)
+        if rows is None:
+            rows = slice(None)
+        a = numpy.asarray(self.data[rows, i], dtype=float)
+        b = numpy.asarray(self.data[rows, i + 1], dtype=float)
+        out = a + f * (b - a)
+        daz = numpy.remainder(b[:, 0] - a[:, 0] + 180.0, 360.0) - 180.0
+        out[:, 0] = numpy.remainder(a[:, 0] + f * daz, 360.0)
+        return nostradamus.Track(*out.T)
+
+################################################################################
+class EphemerisWriter(object):
+    '''Keeps an ephemeris file of every catalog satellite current for the
+       next hours. update() only propagates what the existing file lacks:
+       satellites whose element lines are unchanged keep their samples,
+       shifted when the window moved on, and only the new tail is computed.
+
+       Also usable as the predictor of a TLERefresher: tlesUpdated()
+       refreshes the Predictor and then updates the file.
+    '''
+    def __init__(self, predictor, path=EPHEMERIS_FILE, hours=HOURS, step=STEP,
+                 station=None, filename="tle.txt", roll_period=ROLL_PERIOD):
+        self.predictor   = predictor
+        self.path        = path
+        self.hours       = hours
+        self.step        = step
+        self.station     = station
+        self.filename    = filename
+        self.roll_period = roll_period
+        self.propagated  = 0 # satellite-samples computed by the last update
+        self.updated     = 0
+        self._lock    = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread  = None
+
+    def _existing(self, location):
+        '''Returns the current file if its samples can be reused'''
+        try:
+            old = EphemerisFile(self.path)
+        except (EnvironmentError, ValueError):
+            return None
+        if old.step != self.step or not numpy.allclose(old.location, location):
+            return None
+        return old
+
+    @nostradamus.metrics.timed("ephemeris_update")
+    def update(self, start=None):
+        '''Rewrites the file for the window starting at start (now by
+           default, rounded down to a whole step). Returns the number of
+           satellites propagated from scratch.
+        '''
+        with self._lock:
+            return self._update(start)
+
+    def _update(self, start):
+        if start is None:
+            start = time.time()
+        start = start // self.step * self.step
+        samples = int(self.hours * 3600 // self.step) + 1
+        times = start + numpy.arange(samples) * self.step
+        entries = self.predictor.catalog(self.filename).getEntries()
+        digests = [_digest(e) for e in entries]
+        location = self.predictor.getLocation(self.station)
+
+        old = self._existing(location)
+        reuse = {}  # digest -> row in the old file
+        shift = 0
+        keep = 0    # leading samples available from the old file
+        if old is not None:
+            shift = int(round((start - old.start) / self.step))
+            keep = max(0, min(samples, old.samples - shift))
+            if shift < 0:
+                keep = 0
+            if keep:
+                for row, entry in enumerate(old.directory):
+                    reuse.setdefault(entry["digest"].rstrip("\0"), row)
+
+        count = len(entries)
+        directory = numpy.zeros(count, DIRECTORY)
+        for i, (name, l1, l2) in enumerate(entries):
+            directory[i] = (name.strip()[:24], _norad(l1),
+                            nostradamus.tleEpoch(l1), digests[i])
+
+        fd, tmp = tempfile.mkstemp(prefix=".ephemeris-",
+                                   dir=os.path.dirname(os.path.abspath(self.path)))
+        try:
+            offset = _dataOffset(count)
+            header = HEADER.pack(MAGIC, VERSION, count, samples, FIELDS, start,
+                                 self.step, location[0], location[1],
+                                 location[2],
+                                 str(self.predictor.getStation()
+                                     if self.station is None else self.station))
+            os.write(fd, header.ljust(HEADER_SIZE, "\0"))
+            os.write(fd, directory.tobytes().ljust(offset - HEADER_SIZE, "\0"))
+            os.ftruncate(fd, offset + count * samples * FIELDS * 4)
+            os.close(fd)
+            fd = None
+            data = numpy.memmap(tmp, numpy.float32, 'r+', offset,
+                                (count, samples, FIELDS))
+
+            fresh, tail = [], []
+            for i, digest in enumerate(digests):
+                row = reuse.get(digest.rstrip("\0"))
+                if row is None:
+                    fresh.append(i)
+                    continue
+                data[i, :keep] = old.data[row, shift:shift + keep]
+                if keep < samples:
+                    tail.append(i)
+            self._fill(data, entries, fresh, times, 0)
+            self._fill(data, entries, tail, times, keep)
+            self.propagated = len(fresh) * samples + len(tail) * (samples - keep)
+            data.flush()
+            del data
+            os.chmod(tmp, 0644)
+            os.rename(tmp, self.path)
+            self.updated = time.time()
+        except:
+            if fd is not None:
+                os.close(fd)
+            os.unlink(tmp)
+            raise
+        nostradamus.metrics.inc("ephemeris_updates_total")
+        return len(fresh)
+
+    def _fill(self, data, entries, rows, times, first):
+        '''Propagates rows over times[first:] into data'''
+        if not rows or first >= len(times):
+            return
+        for i in range(0, len(rows), nostradamus.CATALOG_CHUNK):
+            chunk = rows[i:i + nostradamus.CATALOG_CHUNK]
+            track = self.predictor.trackTLEs([entries[r] for r in chunk],
+                                             times[first:], self.station)
+            data[chunk, first:] = numpy.dstack(track)
+
+    # enough of the Predictor interface to stand in for it in a TLERefresher
+    def tlesUpdated(self, filename="tle.txt"):
+        self.predictor.tlesUpdated(filename)
+        self.update()
+
+    def getSatellites(self):
+        return self.predictor.getSatellites()
+
+    def printTLE(self, satName, filename="tle.txt"):
+        return self.predictor.printTLE(satName, filename)
+
+    def _run(self):
+        while not self._stopped.wait(POLL_PERIOD):
+            try:
+                # another process, e.g. the tracker, may have replaced tle.txt
+                changed = self.predictor.catalog(self.filename).refresh()
+                if changed:
+                    self.predictor.tlesUpdated(self.filename)
+                if changed or time.time() - self.updated >= self.roll_period:
+                    self.update()
+            except Exception as e:
+                print("Ephemeris update failed: %s" % e)
+
+    def start(self):
+        '''Writes the file now, then rolls it forward every roll_period and
+           rewrites changed satellites when tle.txt changes
+        '''
+        self.update()
+        self._thread = threading.Thread(target=self._run, name="ephemeris")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+def _norad(line1):
+    try:
+        return int(line1[2:7])
+    except ValueError:
+        return 0
+
+################################################################################
+def main():
+    parser = argparse.ArgumentParser(
+        description="Precompute ephemerides for every catalog satellite")
+    parser.add_argument("--file", default=EPHEMERIS_FILE)
+    parser.add_argument("--hours", type=float, default=HOURS)
+    parser.add_argument("--step", type=float, default=STEP)
+    parser.add_argument("--once", action="store_true",
+                        help="write the file once and exit")
+    parser.add_argument("--show", metavar="SATELLITE",
+                        help="print a satellite from an existing file")
+    args = parser.parse_args()
+
+    if args.show:
+        eph = EphemerisFile(args.file)
+        key = int(args.show) if args.show.isdigit() else args.show
+        track = eph.at(key)
+        if track is None:
+            sys.exit("%s not in %s or file out of date" % (args.show, args.file))
+        print("%s from %s: az %.2f el %.2f range %.1f km range rate %.3f km/s"
+              % (args.show, eph.station, track.az, track.el, track.range,
+                 track.range_rate))
+        return
+
+    n = nostradamus.Predictor()
+    writer = EphemerisWriter(n, args.file, args.hours, args.step)
+    start = time.time()
+    if args.once:
+        writer.update()
+    else:
+        writer.start()
+    print("Wrote %s: %d satellites, %.1f h every %g s in %.1f s"
+          % (args.file, len(n.catalog()), args.hours, args.step,
+             time.time() - start))
+    if args.once:
+        return
+    refresher = nostradamus.TLERefresher(writer)
+    refresher.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        writer.stop()
+        refresher.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+# metrics.py: stage timing, counters and a local Prometheus endpoint
+# Written for UCLA's ELFIN mission <elfin.igpp.ucla.edu>
+
+# Instrumentation is off until enable() is called. While off, a timed
+# function costs one global lookup and a branch on top of the call.
+
+import BaseHTTPServer
+import collections
+import functools
+import threading
+import time
+
+PREFIX  = "nostradamus_"
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+WINDOW  = 1024 # samples kept per stage for the rolling quantiles
+QUANTILES = (0.5, 0.9, 0.99)
+
+STARTED = time.time() # import time, as close to process start as we get
+
+_enabled = False
+_lock    = threading.Lock()
+_stages  = collections.OrderedDict() # stage -> Histogram
+_counters = collections.OrderedDict() # (name, labels) -> value
+_gauges   = collections.OrderedDict() # (name, labels) -> value
+
+################################################################################
+class Histogram(object):
+    '''Cumulative Prometheus-style buckets plus a rolling window of recent
+       samples for quantiles
+    '''
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.total  = 0
+        self.sum    = 0.0
+        self.recent = collections.deque(maxlen=WINDOW)
+
+    def observe(self, seconds):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+        self.total += 1
+        self.sum   += seconds
+        self.recent.append(seconds)
+
+################################################################################
+def enable():
+    global _enabled
+    _enabled = True
+
+def disable():
+    global _enabled
+    _enabled = False
+
+def enabled():
+    return _enabled
+
+def observe(stage, seconds):
+    with _lock:
+        if stage not in _stages:
+            _stages[stage] = Histogram()
+        _stages[stage].observe(seconds)
+
+def inc(name, amount=1, **labels):
+    '''Adds amount to counter name with the given labels'''
+    if not _enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+def gauge(name, value, **labels):
+    '''Sets gauge name with the given labels to value'''
+    if not _enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _gauges[key] = value
+
+def uptime():
+    '''Seconds since this module was first imported'''
+    return time.time() - STARTED
+
+def timed(stage):
+    '''Decorator recording the duration of every call under stage'''
+    def wrap(func):
+        @functools.wraps(func)
+        def timed_func(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(stage, time.time() - start)
+        return timed_func
+    return wrap
+
+class timer(object):
+    '''Context manager recording the duration of a block under stage'''
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.time() if _enabled else None
+        return self
+
+    def __exit__(self, *exc):
+        if self.start is not None:
+            observe(self.stage, time.time() - self.start)
+
+def reset():
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+        _gauges.clear()
+
+################################################################################
+def _labels(pairs):
+    return ",".join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                    for k, v in pairs)
+
+def render():
+    '''Returns all metrics in the Prometheus text exposition format'''
+    out = []
+    with _lock:
+        stages   = [(s, h.counts[:], h.total, h.sum, sorted(h.recent))
+                    for s, h in _stages.items()]
+        counters = list(_counters.items())
+        gauges   = list(_gauges.items())
+    name = PREFIX + "stage_seconds"
+    out.append("# HELP %s Time spent per tracker stage." % name)
+    out.append("# TYPE %s histogram" % name)
+    for stage, counts, total, sum_, recent in stages:
+        running = 0
+        for bound, count in zip(BUCKETS, counts):
+            running += count
+            out.append('%s_bucket{stage="%s",le="%g"} %d'
+                       % (name, stage, bound, running))
+        out.append('%s_bucket{stage="%s",le="+Inf"} %d' % (name, stage, total))
+        out.append('%s_sum{stage="%s"} %.9f' % (name, stage, sum_))
+        out.append('%s_count{stage="%s"} %d' % (name, stage, total))
+    name = PREFIX + "stage_recent_seconds"
+    out.append("# HELP %s Quantiles over the last %d calls per stage."
+               % (name, WINDOW))
+    out.append("# TYPE %s summary" % name)
+    for stage, counts, total, sum_, recent in stages:
+        for q in QUANTILES:
+            value = recent[min(int(q * len(recent)), len(recent) - 1)]
+            out.append('%s{stage="%s",quantile="%g"} %.9f'
+                       % (name, stage, q, value))
+    typed = set()
+    for kind, values in (("counter", counters), ("gauge", gauges)):
+        for (metric, labels), value in values:
+            if metric not in typed:
+                out.append("# TYPE %s%s %s" % (PREFIX, metric, kind))
+                typed.add(metric)
+            if labels:
+                out.append("%s%s{%s} %s" % (PREFIX, metric, _labels(labels),
+                                            value))
+            else:
+                out.append("%s%s %s" % (PREFIX, metric, value))
+    return "\n".join(out) + "\n"
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def serve(port, host="127.0.0.1"):
+    '''Enables instrumentation and serves /metrics from a daemon thread.
+       Raises socket.error, with instrumentation left off, if port is taken.
+    '''
+    server = BaseHTTPServer.HTTPServer((host, port), _Handler)
+    enable()
+    thread = threading.Thread(target=server.serve_forever, name="metrics")
+    thread.daemon = True
+    thread.start()
+    return server
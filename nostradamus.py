@@ -3,14 +3,121 @@
 # By Micah Cliffe (KK6SLK) <micah.cliffe@ucla.edu>
 # Edited by Alexander Gonzalez (KM6ISP) <gonzalezalexander1997@gmail.com>
 
+import collections
 import datetime
-import urllib
+import hashlib
+import os
+import tempfile
+import threading
 import ephem
 import time
+import clock
+import metrics
 from math import *
 
+try:
+    import numpy
+    from sgp4.api import Satrec, SatrecArray
+except ImportError:
+    # track needs numpy and sgp4, snapshot_all falls back to ephem and the
+    # rest only ever runs on ephem
+    numpy       = None
+    Satrec      = None
+    SatrecArray = None
+
 CUBESATS = "http://www.celestrak.com/NORAD/elements/cubesat.txt"
 
+TLE_MAX_AGE      = 2 * 86400 # seconds, older element sets trigger a refresh
+TLE_CHECK_PERIOD = 3600      # seconds between background age checks
+TLE_TIMEOUT      = 30        # seconds per download
+CATALOG_CHUNK    = 256       # satellites per batched sgp4 call in trackTLEs
+
+# Everything one body.compute() gives us. Angles in degrees, range in km,
+# range rate in km/s, sub-satellite point as (lat, long) in degrees.
+SatState = collections.namedtuple("SatState",
+    ["az", "el", "range", "range_rate", "sublat", "sublong", "eclipsed"])
+
+# Predictor.track output, one NumPy array per field in the same units
+Track = collections.namedtuple("Track", ["az", "el", "range", "range_rate"])
+
+# Predictor.snapshot_all output: one column per field, one row per satellite
+# in the order they were added. aos is seconds until the next rise.
+Snapshot = collections.namedtuple("Snapshot",
+    ["names", "az", "el", "range", "range_rate", "aos"])
+
+WGS84_A     = 6378.137          # km
+WGS84_F     = 1 / 298.257223563
+EARTH_OMEGA = 7.292115e-5       # rad/s
+UNIX_EPOCH_JD = 2440587.5
+UNIX_EPOCH    = float(ephem.Date(datetime.datetime(1970, 1, 1)))
+
+def _unix(date):
+    '''Converts an ephem Date to a unix timestamp'''
+    return (float(date) - UNIX_EPOCH) * 86400.0
+
+def _gmst(jd):
+    '''Greenwich mean sidereal time (IAU-82) in radians for UT1 Julian dates'''
+    t = (jd - 2451545.0) / 36525.0
+    sec = (-6.2e-6 * t**3 + 0.093104 * t**2 +
+           (876600.0 * 3600 + 8640184.812866) * t + 67310.54841)
+    return numpy.remainder(numpy.radians(sec / 240.0), 2 * pi)
+
+def _topocentric(observer, jd, r, v):
+    '''Converts TEME position/velocity arrays (km, km/s) from sgp4 into
+       geometric az, el (degrees), range (km) and range rate (km/s) as seen
+       from an ephem Observer. No refraction is applied.
+    '''
+    lat, lon = float(observer.lat), float(observer.long)
+    h  = observer.elevation / 1000.0
+    e2 = WGS84_F * (2 - WGS84_F)
+    N  = WGS84_A / sqrt(1 - e2 * sin(lat)**2)
+    sx = (N + h) * cos(lat) * cos(lon)
+    sy = (N + h) * cos(lat) * sin(lon)
+    sz = (N * (1 - e2) + h) * sin(lat)
+
+    g = _gmst(jd)
+    cg, sg = numpy.cos(g), numpy.sin(g)
+    x =  cg * r[:, 0] + sg * r[:, 1]
+    y = -sg * r[:, 0] + cg * r[:, 1]
+    z = r[:, 2]
+    vx =  cg * v[:, 0] + sg * v[:, 1] + EARTH_OMEGA * y
+    vy = -sg * v[:, 0] + cg * v[:, 1] - EARTH_OMEGA * x
+    vz = v[:, 2]
+
+    dx, dy, dz = x - sx, y - sy, z - sz
+    east  = -sin(lon) * dx + cos(lon) * dy
+    north = (-sin(lat) * cos(lon) * dx - sin(lat) * sin(lon) * dy +
+             cos(lat) * dz)
+    up    = (cos(lat) * cos(lon) * dx + cos(lat) * sin(lon) * dy +
+             sin(lat) * dz)
+    rng  = numpy.sqrt(dx * dx + dy * dy + dz * dz)
+    rate = (dx * vx + dy * vy + dz * vz) / rng
+    az = numpy.remainder(numpy.degrees(numpy.arctan2(east, north)), 360.0)
+    el = numpy.degrees(numpy.arctan2(up, numpy.hypot(east, north)))
+    return Track(az, el, rng, rate)
+
+FREQ_UNITS = {"HZ": 1, "KHZ": 1e3, "MHZ": 1e6, "GHZ": 1e9}
+
+def parseFrequency(text):
+    '''Parses "437.45 MHz" style frequencies into integer Hz. Bare numbers
+       are taken as Hz. Returns None for empty or unparseable values.
+    '''
+    if text is None:
+        return None
+    if isinstance(text, (int, float)):
+        return int(text)
+    parts = text.split()
+    if not parts:
+        return None
+    try:
+        value = float(parts[0])
+    except ValueError:
+        return None
+    unit = parts[1].upper() if len(parts) > 1 else "HZ"
+    if unit not in FREQ_UNITS:
+        return None
+    return int(round(value * FREQ_UNITS[unit]))
+
 ################################################################################
 class Station():
     def __init__(self, name=None, location=("0","0",0), callsign=None):
@@ -29,6 +136,125 @@ class Station():
             self.location.elevation = location[2]
             self.callsign  = callsign
 
+################################################################################
+class TLECatalog(object):
+    '''Parse-once index over a three-line TLE file. Entries are looked up by
+       exact name, NORAD catalog number or international designator, and the
+       file is only parsed again when its mtime or contents change.
+    '''
+    def __init__(self, filename="tle.txt"):
+        self.filename = filename
+        self._mtime   = None
+        self._size    = None
+        self._digest  = None
+        self._entries = []  # (l1, l2, l3) as read from the file
+        self._bodies  = {}  # entry index -> ephem body
+        self._satrecs = {}  # entry index -> sgp4 Satrec
+        self._byName  = {}
+        self._byNorad = {}
+        self._byDesig = {}
+
+    def refresh(self):
+        '''Reparses the file if it changed. Returns True if it was reloaded.'''
+        st = os.stat(self.filename)
+        if (st.st_mtime == self._mtime and st.st_size == self._size):
+            return False
+        with open(self.filename, 'r') as f:
+            data = f.read()
+        self._mtime = st.st_mtime
+        self._size  = st.st_size
+        digest = hashlib.md5(data).hexdigest()
+        if (digest == self._digest):
+            return False
+        self._digest = digest
+        self._parse(data)
+        return True
+
+    @metrics.timed("tle_parse")
+    def _parse(self, data):
+        lines = [l + "\n" for l in data.splitlines() if l.strip()]
+        self._entries = []
+        self._bodies  = {}
+        self._satrecs = {}
+        self._byName  = {}
+        self._byNorad = {}
+        self._byDesig = {}
+        for i in range(0, len(lines) - 2, 3):
+            l1, l2, l3 = lines[i:i+3]
+            idx = len(self._entries)
+            self._entries.append((l1, l2, l3))
+            # first occurrence wins, same as the old line scan
+            self._byName.setdefault(l1.strip(), idx)
+            try:
+                self._byNorad.setdefault(int(l2[2:7]), idx)
+            except ValueError:
+                pass
+            desig = l2[9:17].strip()
+            if desig:
+                self._byDesig.setdefault(desig, idx)
+
+    def _find(self, key):
+        if isinstance(key, int):
+            return self._byNorad.get(key)
+        key = str(key).strip()
+        for index in (self._byName, self._byDesig):
+            if key in index:
+                return index[key]
+        if key.isdigit():
+            if int(key) in self._byNorad:
+                return self._byNorad[int(key)]
+        # fall back to the substring match loadTLE has always done
+        for idx, entry in enumerate(self._entries):
+            if key in entry[0]:
+                return idx
+        return None
+
+    def getLines(self, key):
+        '''Returns the raw (name, line 1, line 2) tuple or None'''
+        self.refresh()
+        idx = self._find(key)
+        if idx is None:
+            return None
+        return self._entries[idx]
+
+    def getBody(self, key):
+        '''Returns the cached ephem body for key or None'''
+        self.refresh()
+        idx = self._find(key)
+        if idx is None:
+            return None
+        return self._body(idx)
+
+    def getBodies(self):
+        '''Returns ephem bodies for every entry in the file'''
+        self.refresh()
+        return [self._body(i) for i in range(len(self._entries))]
+
+    def getEntries(self):
+        '''Returns the raw (name, line 1, line 2) tuple of every entry'''
+        self.refresh()
+        return list(self._entries)
+
+    def getSatrec(self, key):
+        '''Returns the cached sgp4 Satrec for key or None'''
+        self.refresh()
+        idx = self._find(key)
+        if idx is None:
+            return None
+        if idx not in self._satrecs:
+            l1, l2, l3 = self._entries[idx]
+            self._satrecs[idx] = Satrec.twoline2rv(l2.strip(), l3.strip())
+        return self._satrecs[idx]
+
+    def _body(self, idx):
+        if idx not in self._bodies:
+            self._bodies[idx] = ephem.readtle(*self._entries[idx])
+        return self._bodies[idx]
+
+    def __len__(self):
+        self.refresh()
+        return len(self._entries)
+
 ################################################################################
 # TODO: inherit from ephem Body!!!!!
 class Satellite(object):
@@ -63,30 +289,218 @@ class Satellite(object):
             self.mode     = mode
             self.callsign = callsign
 
-    def getPosition(self, observer):
-        '''Returns azimuth and elevation'''
+    def uplinkHz(self):
+        '''Returns the uplink frequency in Hz or None'''
+        return parseFrequency(self.uplink)
+
+    def downlinkHz(self):
+        '''Returns the downlink frequency in Hz or None'''
+        return parseFrequency(self.downlink)
+
+    @metrics.timed("ephem_compute")
+    def getState(self, observer):
+        '''Returns a SatState from a single compute'''
         body = self.body
         body.compute(observer)
-        return (degrees(body.az), degrees(body.alt))
+        return SatState(degrees(body.az), degrees(body.alt),
+                        body.range / 1000, body.range_velocity / 1000,
+                        degrees(body.sublat), degrees(body.sublong),
+                        bool(body.eclipsed))
+
+    def getPosition(self, observer):
+        '''Returns azimuth and elevation'''
+        state = self.getState(observer)
+        return (state.az, state.el)
 
     def getVelocity(self, observer):
-        body = self.body
-        body.compute(observer)
-        velocity = body.range_velocity / 1000
-        return velocity
+        '''Returns range rate in km/s'''
+        return self.getState(observer).range_rate
 
     def getAzimuth(self, observer):
         '''Returns azimuth in degrees'''
-        body = self.body
-        body.compute(observer)
-        return degrees(body.az)
+        return self.getState(observer).az
 
     def getElevation(self, observer):
         '''Returns elevation (above horizon) in degrees'''
-        body = self.body
-        body.compute(observer)
-        return degrees(body.alt)
+        return self.getState(observer).el
+
+
+################################################################################
+def tleEpoch(line1):
+    '''Returns the epoch of a TLE line 1 as a unix timestamp'''
+    year = int(line1[18:20])
+    year += 2000 if year < 57 else 1900
+    day  = float(line1[20:32])
+    start = datetime.datetime(year, 1, 1) - datetime.datetime(1970, 1, 1)
+    return start.days * 86400.0 + (day - 1) * 86400.0
+
+def mergeTLEs(sources):
+    '''Merges TLE file contents into one. A satellite listed by several
+       sources keeps its newest element set, in the order first seen.
+    '''
+    order  = []
+    newest = {}
+    for data in sources:
+        lines = [l.rstrip() for l in data.splitlines() if l.strip()]
+        for i in range(0, len(lines) - 2, 3):
+            entry = tuple(lines[i:i+3])
+            key = entry[1][2:7]
+            if key not in newest:
+                order.append(key)
+                newest[key] = entry
+            elif tleEpoch(entry[1]) > tleEpoch(newest[key][1]):
+                newest[key] = entry
+    return "".join("\n".join(newest[k]) + "\n" for k in order)
+
+class TLERefresher(object):
+    '''Keeps a TLE file current from one or more source URLs.
+
+       Downloads are conditional (ETag / If-Modified-Since), the merged
+       result is written to a temp file and renamed over the old one so
+       readers never see a partial file, and the predictor is told to drop
+       its caches. start() checks in the background every check_period and
+       refreshes once the oldest element set in use is older than max_age.
+    '''
+    def __init__(self, predictor=None, urls=(CUBESATS,), filename="tle.txt",
+                 max_age=TLE_MAX_AGE, check_period=TLE_CHECK_PERIOD,
+                 timeout=TLE_TIMEOUT):
+        self.predictor    = predictor
+        self.urls         = list(urls)
+        self.filename     = filename
+        self.max_age      = max_age
+        self.check_period = check_period
+        self.timeout      = timeout
+        self.lastRefresh  = None
+        self._sources = {}  # url -> (etag, last modified, body)
+        self._stop    = threading.Event()
+        self._thread  = None
+
+    def _fetch(self, url):
+        '''Returns the body at url, or the cached body if it is unchanged'''
+        # only downloads need urllib2, keep it off the startup path
+        import urllib2
+        etag, modified, body = self._sources.get(url, (None, None, None))
+        request = urllib2.Request(url)
+        if body is not None:
+            if etag:
+                request.add_header("If-None-Match", etag)
+            if modified:
+                request.add_header("If-Modified-Since", modified)
+        try:
+            response = urllib2.urlopen(request, timeout=self.timeout)
+        except urllib2.HTTPError as e:
+            if e.code == 304:
+                return body, False
+            raise
+        data = response.read()
+        self._sources[url] = (response.info().getheader("ETag"),
+                              response.info().getheader("Last-Modified"),
+                              data)
+        return data, data != body
+
+    def refresh(self):
+        '''Fetches every source and replaces the file if anything changed.
+           Returns True if the file was replaced. Raises on download errors,
+           leaving the existing file untouched.
+        '''
+        bodies  = []
+        changed = not os.path.exists(self.filename)
+        for url in self.urls:
+            data, fresh = self._fetch(url)
+            bodies.append(data)
+            changed = changed or fresh
+        self.lastRefresh = time.time()
+        if not changed:
+            return False
+        merged = mergeTLEs(bodies)
+        if not merged:
+            raise ValueError("no TLEs in " + ", ".join(self.urls))
+        folder = os.path.dirname(os.path.abspath(self.filename))
+        fd, tmp = tempfile.mkstemp(prefix=".tle", dir=folder)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(merged)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmp, 0o644)
+            os.rename(tmp, self.filename)
+        except Exception:
+            os.remove(tmp)
+            raise
+        metrics.inc("tle_refreshes_total")
+        if self.predictor is not None:
+            self.predictor.tlesUpdated(self.filename)
+        return True
+
+    def oldestEpoch(self):
+        '''Returns the oldest TLE epoch in use, as a unix timestamp'''
+        epochs = []
+        if self.predictor is not None:
+            for name in self.predictor.getSatellites():
+                lines = self.predictor.printTLE(name, self.filename)
+                if lines:
+                    epochs.append(tleEpoch(lines[1]))
+        if not epochs and os.path.exists(self.filename):
+            epochs.append(os.path.getmtime(self.filename))
+        return min(epochs) if epochs else None
+
+    def needsRefresh(self, date=None):
+        if date is None:
+            date = clock.now()
+        oldest = self.oldestEpoch()
+        return oldest is None or date - oldest > self.max_age
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self.needsRefresh():
+                    self.refresh()
+            except Exception as e:
+                print(e)
+                print("Failed to update TLEs.")
+            self._stop.wait(self.check_period)
 
+    def start(self):
+        '''Starts background refreshing'''
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="tle refresh")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+################################################################################
+class PassTrajectory(object):
+    '''Dense az/el/range rate table for one pass on an even time grid.
+       Lookups are plain-Python linear interpolation so they cost
+       microseconds; az is unwrapped so interpolation never crosses 0/360.
+    '''
+    def __init__(self, satName, aos, los, times, track, epoch):
+        self.name  = satName
+        self.aos   = aos
+        self.los   = los
+        self.epoch = epoch
+        self.start = float(times[0])
+        self.step  = float(times[1] - times[0]) if len(times) > 1 else 1.0
+        self.size  = len(times)
+        self.az    = numpy.degrees(numpy.unwrap(numpy.radians(track.az))).tolist()
+        self.el    = track.el.tolist()
+        self.range_rate = track.range_rate.tolist()
+
+    def covers(self, date):
+        return self.start <= date <= self.start + (self.size - 1) * self.step
+
+    def at(self, date):
+        '''Returns interpolated (az, el, range rate) at unix time date'''
+        x = (date - self.start) / self.step
+        i = min(max(int(x), 0), self.size - 2) if self.size > 1 else 0
+        f = min(max(x - i, 0.0), 1.0) if self.size > 1 else 0.0
+        j = min(i + 1, self.size - 1)
+        az = self.az[i] + f * (self.az[j] - self.az[i])
+        el = self.el[i] + f * (self.el[j] - self.el[i])
+        rr = self.range_rate[i] + f * (self.range_rate[j] - self.range_rate[i])
+        return (az % 360.0, el, rr)
 
 ################################################################################
 class Predictor(object):
@@ -97,21 +511,65 @@ class Predictor(object):
                 creation
         '''
         self._station = None
+        self._stations = collections.OrderedDict()  # name -> Station
         if (knudsen):
             self._station = station = Station("KNUDSEN")
+            self._stations[station.name] = station
         self._sats = []
+        self._satIndex = {}  # name -> Satellite, first added wins
+        self._catalogs = {}
+        # (station, satellite) -> (TLE epoch, [passes]), see nextpass
+        self._passes = {}
+        self._satrecArray = (None, None, None)  # see snapshot_all
+        self._trajectories = {}  # (station, satellite) -> PassTrajectory
         # TODO: call self.updateTLEs() automatically upon creating maybe
 
     ### Station Details ###
 
     def setStation(self, name=None, location=("0","0",0), callsign=None):
         self._station = Station(name, location, callsign)
+        self._stations[name] = self._station
 
     def getStation(self):
         if hasattr(self._station, 'name'):
             return self._station.name
         return None
 
+    def addStation(self, name, location=("0","0",0), callsign=None):
+        '''Adds a ground station to the network. The first one added also
+           becomes the default station used when no station is given.
+        '''
+        station = Station(name, location, callsign)
+        self._stations[name] = station
+        if self._station is None:
+            self._station = station
+        return station
+
+    def removeStation(self, name):
+        if name not in self._stations:
+            return False
+        station = self._stations.pop(name)
+        if station is self._station:
+            self._station = None
+            for other in self._stations.values():
+                self._station = other
+                break
+        return True
+
+    def getStations(self):
+        return list(self._stations.keys())
+
+    def getLocation(self, station=None):
+        '''Returns (latitude, longitude) in degrees and elevation in m'''
+        location = self._getStation(station).location
+        return (degrees(location.lat), degrees(location.long),
+                location.elevation)
+
+    def _getStation(self, name=None):
+        if name is None:
+            return self._station
+        return self._stations[name]
+
     ### Satellite Details ###
 
     def addSatellite(self, name, owner=None, uplink=None,
@@ -119,7 +577,6 @@ class Predictor(object):
         if (name.upper() == "FIREBIRD"):
             name = "FIREBIRD 4"
         body = self.loadTLE(name)
-        sat = Satellite(body, name, owner, uplink, downlink, mode, callsign)
         #for s in self._sats:
         #    if (name == sat.name):
         #        print("Satellite already exists.")
@@ -128,22 +585,25 @@ class Predictor(object):
         if not body:
             print("TLE not found for " + name)
             return False
-        #sat = Satellite(body, name, owner, uplink, downlink, mode, callsign)
+        sat = Satellite(body, name, owner, uplink, downlink, mode, callsign)
         self._sats.append(sat)
+        self._satIndex.setdefault(sat.name, sat)
         return True
 
     def removeSatellite(self, name):
         for s in self._sats:
             if (s.name == name):
                 self._sats.remove(s)
+                del self._satIndex[name]
+                for other in self._sats:
+                    if (other.name == name):
+                        self._satIndex[name] = other
+                        break
                 return True
         return False
 
     def getSatellite(self, name):
-        for s in self._sats:
-            if s.name == name:
-                return s
-        return None
+        return self._satIndex.get(name)
 
     def getSatellites(self):
         return [s.name for s in self._sats]
@@ -152,133 +612,324 @@ class Predictor(object):
 
     def updateTLEs(self, url=CUBESATS):
         try:
-            urllib.urlretrieve(url, "tle.txt")
+            TLERefresher(self, [url]).refresh()
         except Exception as e:
             print(e)
             print("Failed to update TLEs.")
             return False
         return True
 
+    def tlesUpdated(self, filename="tle.txt"):
+        '''Drops everything derived from the old element sets. Called by
+           TLERefresher after it replaces filename.
+        '''
+        self.catalog(filename).refresh()
+        for sat in self._sats:
+            body = self.loadTLE(sat.name, filename)
+            if body is not None:
+                sat.body = body
+        self._passes = {}
+        self._trajectories = {}
+        self._satrecArray = (None, None, None)
+
+    def catalog(self, filename="tle.txt"):
+        '''Returns the parse-once TLECatalog for filename'''
+        if filename not in self._catalogs:
+            self._catalogs[filename] = TLECatalog(filename)
+        return self._catalogs[filename]
+
     # Not used probably
     def loadTLEs(self, filename="tle.txt"):
-        with open(filename, 'r') as f:
-            sats = []
-            l1   = f.readline()
-            while l1:
-                l2  = f.readline()
-                l3  = f.readline()
-                sat = ephem.readtle(l1, l2, l3)
-                sats.append(sat)
-                print sat.name
-                l1 = f.readline()
+        sats = self.catalog(filename).getBodies()
+        for sat in sats:
+            print sat.name
         print("%i satellites loaded."%len(sats))
         return sats
 
+    @metrics.timed("predictor_loadTLE")
     def loadTLE(self, satName, filename="tle.txt"):
-        sat = None
-        with open(filename, 'r') as f:
-            l1  = f.readline()
-            while l1:
-                if satName in l1:
-                    l2  = f.readline()
-                    l3  = f.readline()
-                    sat = ephem.readtle(l1, l2, l3)
-                    break
-                f.readline()
-                f.readline()
-                l1 = f.readline()
-        return sat
+        return self.catalog(filename).getBody(satName)
+
     def printTLE(self, satName, filename="tle.txt"):
-        sat = None
-        with open(filename, 'r') as f:
-            l1  = f.readline()
-            while l1:
-                if satName in l1:
-                    l2  = f.readline()
-                    l3  = f.readline()
-                    sat = (l1, l2, l3)
-                    break
-                f.readline()
-                f.readline()
-                l1 = f.readline()
-        return sat
+        return self.catalog(filename).getLines(satName)
 
 
     ### Performance Functions ###
 
-    def position(self, satName, date=None):
+    def _setDate(self, date, station=None):
         # date currently set to 'now' unless otherwise inputted
         if not date:
-            date = time.time()
-        self._station.location.date = datetime.datetime.utcfromtimestamp(date)
-        sat = None
-        for s in self._sats:
-            if (s.name == satName):
-                sat = s
-                break
+            date = clock.now()
+        location = self._getStation(station).location
+        location.date = datetime.datetime.utcfromtimestamp(date)
+        return location
+
+    @metrics.timed("predictor_state")
+    def state(self, satName, date=None, station=None):
+        '''Returns a SatState (az, el, range, range rate, sub-satellite point,
+           eclipse flag) for satName from one compute, or None if the
+           satellite was never added
+        '''
+        sat = self.getSatellite(satName)
         if sat:
-            return sat.getPosition(self._station.location)
+            return sat.getState(self._setDate(date, station))
         return None
 
-    def nextpass(self, satName, date=None):
+    def _propagate(self, satName, times):
+        '''Runs sgp4 once over an array of unix timestamps. Returns the
+           Julian dates, TEME r and v, and the sgp4 error codes.
+        '''
+        if numpy is None:
+            raise ImportError("Predictor.track requires numpy and sgp4")
+        satrec = self.catalog().getSatrec(satName)
+        times = numpy.atleast_1d(numpy.asarray(times, dtype=float))
+        days  = numpy.floor(times / 86400.0)
+        jd = UNIX_EPOCH_JD + days
+        fr = (times - days * 86400.0) / 86400.0
+        err, r, v = satrec.sgp4_array(jd, fr)
+        return jd + fr, r, v, err
+
+    def _look(self, station, jd, r, v, err):
+        track = _topocentric(self._getStation(station).location, jd, r, v)
+        if err.any():
+            for arr in track:
+                arr[err != 0] = numpy.nan
+        return track
+
+    @metrics.timed("predictor_track")
+    def track(self, satName, times, station=None):
+        '''Propagates satName over an array of unix timestamps in one batched
+           sgp4 call. Returns a Track of NumPy arrays (az, el in degrees,
+           range in km, range rate in km/s); samples sgp4 rejects are NaN.
+        '''
+        sat = self.getSatellite(satName)
+        if not sat:
+            return None
+        return self._look(station, *self._propagate(sat.name, times))
+
+    @metrics.timed("predictor_track")
+    def trackNetwork(self, satName, times, stations=None):
+        '''Like track, for every station (or the given station names) at
+           once. The satellite is propagated a single time and only the
+           topocentric conversion is repeated per station. Returns a dict
+           of station name -> Track.
+        '''
+        sat = self.getSatellite(satName)
+        if not sat:
+            return None
+        if stations is None:
+            stations = self.getStations()
+        propagated = self._propagate(sat.name, times)
+        return dict((name, self._look(name, *propagated))
+                    for name in stations)
+
+    @metrics.timed("predictor_track_tles")
+    def trackTLEs(self, entries, times, station=None):
+        '''Propagates raw (name, line 1, line 2) TLE entries, e.g. from
+           TLECatalog.getEntries, over an array of unix timestamps without
+           adding them as satellites. Runs CATALOG_CHUNK satellites per
+           batched sgp4 call. Returns a Track of (satellite, time) arrays.
+        '''
+        if numpy is None:
+            raise ImportError("Predictor.trackTLEs requires numpy and sgp4")
+        times = numpy.atleast_1d(numpy.asarray(times, dtype=float))
+        days = numpy.floor(times / 86400.0)
+        jd = UNIX_EPOCH_JD + days
+        fr = (times - days * 86400.0) / 86400.0
+        shape = (len(entries), len(times))
+        out = Track(*[numpy.empty(shape) for f in Track._fields])
+        for i in range(0, len(entries), CATALOG_CHUNK):
+            chunk = entries[i:i + CATALOG_CHUNK]
+            satrecs = [Satrec.twoline2rv(l1.strip(), l2.strip())
+                       for name, l1, l2 in chunk]
+            err, r, v = SatrecArray(satrecs).sgp4(jd, fr)
+            look = self._look(station, numpy.tile(jd + fr, len(chunk)),
+                              r.reshape(-1, 3), v.reshape(-1, 3),
+                              err.reshape(-1))
+            for field, arr in zip(out, look):
+                field[i:i + len(chunk)] = arr.reshape(len(chunk), -1)
+        return out
+
+    @metrics.timed("predictor_trajectory")
+    def trajectory(self, satName, date=None, step=1.0, station=None):
+        '''Returns a PassTrajectory covering the pass in progress at date, or
+           the next one, sampled every step seconds. Tables are cached per
+           pass and dropped once the pass reaches LOS or the TLE changes.
+           Returns None without numpy/sgp4 or for unknown satellites.
+        '''
+        if numpy is None:
+            return None
+        sat = self.getSatellite(satName)
+        if not sat:
+            return None
         if not date:
-            date = time.time()
-        self._station.location.date = datetime.datetime.utcfromtimestamp(date)
-        sat = None
-        for s in self._sats:
-            if (s.name == satName):
-                sat = s
-                break
+            date = clock.now()
+        key = (self._stationKey(station), sat.name)
+        traj = self._trajectories.get(key)
+        p = self.nextpass(satName, date, station)
+        epoch = float(sat.body._epoch)
+        if traj is not None and (date > traj.los or traj.epoch != epoch):
+            del self._trajectories[key]
+            traj = None
+        if traj is not None:
+            return traj
+        if p is None or p[0] is None or p[4] is None:
+            return None
+        aos, los = _unix(p[0]), _unix(p[4])
+        if self.state(satName, date, station).el > 0:
+            # nextpass skips a pass in progress, find where this one sets
+            observer = self._setDate(date, station)
+            current = observer.next_pass(sat.body, singlepass=False)
+            if current[4] is not None and _unix(current[4]) > date:
+                aos, los = date, _unix(current[4])
+        times = numpy.arange(aos, los + step, step)
+        traj = PassTrajectory(sat.name, aos, los, times,
+                              self.track(satName, times, station), epoch)
+        self._trajectories[key] = traj
+        return traj
+
+    def snapshot_all(self, date=None, station=None):
+        '''Evaluates every added satellite at date in one batched sgp4 call
+           (one ephem compute each if sgp4 is missing) and returns a Snapshot
+           table. Passes come from the nextpass cache.
+        '''
+        if station is None:
+            station = self.getStation()
+        return self.snapshotNetwork(date, [station])[station]
+
+    @metrics.timed("predictor_snapshot")
+    def snapshotNetwork(self, date=None, stations=None):
+        '''snapshot_all for every station (or the given station names).
+           All satellites are propagated once and shared by the stations.
+           Returns a dict of station name -> Snapshot.
+        '''
+        if not date:
+            date = clock.now()
+        if stations is None:
+            stations = self.getStations()
+        names = []
+        for name in self.getSatellites():
+            if name not in names:
+                names.append(name)
+        if not names:
+            return dict((st, Snapshot([], [], [], [], [], []))
+                        for st in stations)
+        columns = {}
+        if numpy is None:
+            for st in stations:
+                states = [self.state(name, date, st) for name in names]
+                columns[st] = [[s[i] for s in states] for i in range(4)]
+        else:
+            catalog = self.catalog()
+            satrecs = [catalog.getSatrec(name) for name in names]
+            key = tuple(id(sr) for sr in satrecs)
+            if self._satrecArray[0] != key:
+                # keep satrecs referenced so their ids stay unique
+                self._satrecArray = (key, SatrecArray(satrecs), satrecs)
+            days = floor(date / 86400.0)
+            jd = numpy.array([UNIX_EPOCH_JD + days])
+            fr = numpy.array([(date - days * 86400.0) / 86400.0])
+            err, r, v = self._satrecArray[1].sgp4(jd, fr)
+            for st in stations:
+                columns[st] = list(self._look(st, jd[0] + fr[0], r[:, 0],
+                                              v[:, 0], err[:, 0]))
+        now = ephem.Date(datetime.datetime.utcfromtimestamp(date))
+        tables = {}
+        for st in stations:
+            aos = []
+            for name in names:
+                p = self.nextpass(name, date, st)
+                if p is None or p[0] is None:
+                    aos.append(None)
+                else:
+                    aos.append((p[0] - now) * 86400.0)
+            cols = columns[st]
+            tables[st] = Snapshot(names, cols[0], cols[1], cols[2], cols[3],
+                                  aos)
+        return tables
+
+    def position(self, satName, date=None, station=None):
+        state = self.state(satName, date, station)
+        if state:
+            return (state.az, state.el)
+        return None
+
+    @metrics.timed("predictor_nextpass")
+    def nextpass(self, satName, date=None, station=None):
+        sat = self.getSatellite(satName)
         if sat:
-            #change station if necessary
-            return Station("KNUDSEN").location.next_pass(Predictor().loadTLE(satName))
+            return self._cachedPass(sat, self._setDate(date, station),
+                                    self._stationKey(station))
         # creates six-element tuple
         # 0 Rise time
         # 1 Rise azimuth
         # 2 Maximum altitude time
         # 3 Maximum altitude
         # 4 Set time
-           # 5 Set azimuth
+        # 5 Set azimuth
 
         return None
 
-    def velocity(self, satName, date=None):
-        if not date:
-            date = time.time()
-        self._station.location.date = datetime.datetime.utcfromtimestamp(date)
-        sat = None
-        for s in self._sats:
-            if (s.name == satName):
-                sat = s
-                break
-        if sat:
-            return sat.getVelocity(self._station.location)
+    def _stationKey(self, station=None):
+        station = self._getStation(station)
+        loc = station.location
+        return (station.name, float(loc.lat), float(loc.long), loc.elevation)
+
+    def _cachedPass(self, sat, observer, stationKey):
+        '''Returns observer.next_pass(sat.body) from the pass cache. Passes are
+           kept per (station, satellite, TLE epoch) and dropped after their
+           LOS, so repeated queries within a pass never hit the root finder.
+           The cache holds every pass from the time its search started, and
+           an earlier query starts it over.
+        '''
+        body = self.loadTLE(sat.name)
+        if body is not None and body is not sat.body:
+            # tle.txt was refreshed since the satellite was added
+            sat.body = body
+        body  = sat.body
+        key   = (stationKey, sat.name)
+        epoch = float(body._epoch)
+        now   = float(observer.date)
+        cached = self._passes.get(key)
+        if cached is None or cached[0] != epoch or now < cached[1]:
+            # [epoch, start of the searched span, passes found in it]
+            cached = self._passes[key] = [epoch, now, []]
+        passes = cached[2]
+        # forget passes that have already reached LOS
+        while passes and passes[0][4] <= now:
+            cached[1] = passes.pop(0)[4]
+        if not passes:
+            cached[1] = now
+        for p in passes:
+            if p[0] > now:
+                return p
+        # search after the last cached pass so the current one is kept
+        if passes:
+            observer.date = passes[-1][4]
+        with metrics.timer("ephem_next_pass"):
+            p = observer.next_pass(body)
+        observer.date = now
+        if p[0] is None or p[4] is None:
+            return p
+        passes.append(p)
+        return p
+
+    def velocity(self, satName, date=None, station=None):
+        state = self.state(satName, date, station)
+        if state:
+            return state.range_rate
         return None
 
-    def azimuth(self, satName, date=None):
-        if not date:
-            date = time.time()
-        self._station.location.date = datetime.datetime.utcfromtimestamp(    date)
-        sat = None
-        for s in self._sats:
-            if (s.name == satName):
-                sat = s
-                break
-        if sat:
-            return sat.getAzimuth(self._station.location)
+    def azimuth(self, satName, date=None, station=None):
+        state = self.state(satName, date, station)
+        if state:
+            return state.az
         return None
 
-    def elevation(self, satName, date=None):
-        if not date:
-            date = time.time()
-        self._station.location.date = datetime.datetime.utcfromtimestamp(date)
-        sat = None
-        for s in self._sats:
-            if (s.name == satName):
-                sat = s
-                break
-        if sat:
-            return sat.getElevation(self._station.location)
+    def elevation(self, satName, date=None, station=None):
+        state = self.state(satName, date, station)
+        if state:
+            return state.el
         return None
 
 #TODO: what happens when TLE file doesn't exist, when can't update, when
@@ -0,0 +1,205 @@
+#!/usr/bin/python
+
+# pathplan.py: az/el command paths for whole passes on the RT-21 array
+# Written for UCLA's ELFIN mission <elfin.igpp.ucla.edu>
+
+# start_rotor.sh lets the az rotor run from -5 to 360 degrees and the el
+# rotor up to 185. Every direction can be reached two ways: normal,
+# (az, el), or flipped over the top, (az + 180, 180 - el). planPass looks at
+# a whole PassTrajectory and picks, sample by sample, the way (and which
+# turn of the az range) that loses the least time slewing:
+#
+# - a pass crossing north is flown flipped, so az never has to unwind
+#   through 360 degrees in the middle of it
+# - a high pass switches to flip at culmination, where the satellite's az
+#   swings through 180 degrees in seconds: el moves a few degrees past 90
+#   instead of az slewing half a turn
+#
+#   ./pathplan.py "FIREBIRD 4"
+
+import argparse
+import collections
+import time
+import metrics
+
+AZ_LIMITS  = (-5.0, 360.0) # degrees, as set in start_rotor.sh
+EL_LIMITS  = (0.0, 185.0)
+SLEW_RATE  = 5.0           # degrees per second per axis
+SLEW_COST  = 0.001         # weight of slew seconds that cost no tracking
+
+NORMAL = 0
+FLIP   = 1
+MODES  = ("normal", "flip")
+
+# One candidate pointing for a sample: the commanded angles, how they were
+# reached (NORMAL or FLIP) and which turn of the az range they are on.
+_Pose = collections.namedtuple("_Pose", ["az", "el", "mode", "turn"])
+
+################################################################################
+class PassPlan(object):
+    '''Commanded az/el for every sample of a pass. at() interpolates
+       between samples on the same pose and jumps ahead to the next sample
+       across a flip or an az unwind, so the rotors start moving early.
+       lost is the tracking time in seconds the planned slews are expected
+       to cost at rate degrees per second.
+    '''
+    def __init__(self, name, times, poses, lost, slew):
+        self.name  = name
+        self.times = times
+        self.az    = [p.az for p in poses]
+        self.el    = [p.el for p in poses]
+        self.modes = [p.mode for p in poses]
+        self.turns = [p.turn for p in poses]
+        self.lost  = lost
+        self.slew  = slew
+        self.start = times[0]
+        self.step  = times[1] - times[0] if len(times) > 1 else 1.0
+        self.size  = len(times)
+
+    @property
+    def mode(self):
+        '''"flip" if any part of the pass is flown flipped, else "normal"'''
+        return MODES[max(self.modes)]
+
+    def switches(self):
+        '''Returns the times at which the pose changes'''
+        return [self.times[i] for i in range(1, self.size)
+                if self._pose(i) != self._pose(i - 1)]
+
+    def _pose(self, i):
+        return (self.modes[i], self.turns[i])
+
+    def covers(self, date):
+        return self.start <= date <= self.start + (self.size - 1) * self.step
+
+    def at(self, date):
+        '''Returns the commanded (az, el) at unix time date'''
+        x = (date - self.start) / self.step
+        i = min(max(int(x), 0), self.size - 2) if self.size > 1 else 0
+        f = min(max(x - i, 0.0), 1.0) if self.size > 1 else 0.0
+        j = min(i + 1, self.size - 1)
+        if self._pose(i) != self._pose(j):
+            return (self.az[j], self.el[j])
+        return (self.az[i] + f * (self.az[j] - self.az[i]),
+                self.el[i] + f * (self.el[j] - self.el[i]))
+
+    def commands(self, deadband=0.25):
+        '''Returns the planned command sequence as (time, az, el), one entry
+           whenever either axis has moved deadband degrees or the pose
+           changes
+        '''
+        out = []
+        for i in range(self.size):
+            if out:
+                t, az, el = out[-1]
+                if (self._pose(i) == self._pose(i - 1) and
+                        abs(self.az[i] - az) < deadband and
+                        abs(self.el[i] - el) < deadband):
+                    continue
+            out.append((self.times[i], self.az[i], self.el[i]))
+        return out
+
+################################################################################
+def _poses(az, el, flip, az_limits, el_limits):
+    '''Every way of pointing at satellite az/el within the rotor limits'''
+    el = max(el, 0.0)
+    out = []
+    for mode in ((NORMAL, FLIP) if flip else (NORMAL,)):
+        if mode == NORMAL:
+            base, cmd_el = az % 360.0, el
+        else:
+            base, cmd_el = (az + 180.0) % 360.0, 180.0 - el
+        cmd_el = min(max(cmd_el, el_limits[0]), el_limits[1])
+        for turn in (-1, 0, 1):
+            cmd_az = base + 360.0 * turn
+            if az_limits[0] <= cmd_az <= az_limits[1]:
+                out.append(_Pose(cmd_az, cmd_el, mode, turn))
+    return out
+
+def _slewTime(a, b, rate):
+    return max(abs(a.az - b.az), abs(a.el - b.el)) / rate
+
+@metrics.timed("pathplan_plan_pass")
+def planPass(traj, position=None, flip=True, az_limits=AZ_LIMITS,
+             el_limits=EL_LIMITS, rate=SLEW_RATE):
+    '''Plans the commanded path for a PassTrajectory. position is where the
+       rotors are as (az, el), if known, so the start of the pass is picked
+       close to it. flip=False only ever points normally. Returns a
+       PassPlan, or None for an empty trajectory.
+    '''
+    if traj is None or traj.size == 0:
+        return None
+    times = [traj.start + i * traj.step for i in range(traj.size)]
+    # Shortest path through a trellis of at most four poses per sample. A
+    # step costs the time its slew takes beyond the sample spacing, which
+    # is the tracking it loses, plus a little per slew second to prefer
+    # the calmer of two equally good paths.
+    layers = [_poses(traj.az[i], traj.el[i], flip, az_limits, el_limits)
+              for i in range(traj.size)]
+    start = None
+    if position is not None:
+        start = _Pose(position[0], position[1], None, None)
+    cost = [SLEW_COST * _slewTime(start, p, rate) if start else 0.0
+            for p in layers[0]]
+    back = [[None] * len(layers[0])]
+    for i in range(1, traj.size):
+        dt = times[i] - times[i - 1]
+        prev, layer = layers[i - 1], layers[i]
+        new_cost, new_back = [], []
+        for p in layer:
+            best = None
+            for k in range(len(prev)):
+                s = _slewTime(prev[k], p, rate)
+                c = cost[k] + max(s - dt, 0.0) + SLEW_COST * s
+                if best is None or c < best[0]:
+                    best = (c, k)
+            new_cost.append(best[0])
+            new_back.append(best[1])
+        cost = new_cost
+        back.append(new_back)
+    k = min(range(len(cost)), key=cost.__getitem__)
+    path = []
+    for i in range(traj.size - 1, -1, -1):
+        path.append(layers[i][k])
+        k = back[i][k]
+    path.reverse()
+    lost = slew = 0.0
+    for i in range(1, traj.size):
+        s = _slewTime(path[i - 1], path[i], rate)
+        lost += max(s - (times[i] - times[i - 1]), 0.0)
+        slew += s
+    return PassPlan(traj.name, times, path, lost, slew)
+
+################################################################################
+def _utc(t):
+    return time.strftime("%H:%M:%S", time.gmtime(t))
+
+def main():
+    import nostradamus
+    parser = argparse.ArgumentParser(
+        description="Print the planned rotor path for a satellite's next pass")
+    parser.add_argument("satellite")
+    parser.add_argument("--start", type=float,
+                        help="unix time to plan from, default now")
+    parser.add_argument("--no-flip", action="store_true")
+    args = parser.parse_args()
+
+    n = nostradamus.Predictor()
+    if not n.addSatellite(args.satellite):
+        raise SystemExit("no TLE for %s" % args.satellite)
+    traj = n.trajectory(args.satellite, args.start or time.time())
+    if traj is None:
+        raise SystemExit("no upcoming pass for %s" % args.satellite)
+    plan = planPass(traj, flip=not args.no_flip)
+    naive = planPass(traj, flip=False, az_limits=(0.0, 360.0))
+    print "%s: AOS %s LOS %s, max el %.1f" % (traj.name, _utc(traj.aos),
+                                              _utc(traj.los), max(traj.el))
+    print "mode %s, %d pose changes, %.0f s slewing, %.1f s lost" % (
+        plan.mode, len(plan.switches()), plan.slew, plan.lost)
+    print "raw az/el would lose %.1f s" % naive.lost
+    print
+    for t, az, el in plan.commands():
+        print "%s  P %7.2f %6.2f" % (_utc(t), az, el)
+
+if __name__ == "__main__":
+    main()
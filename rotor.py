@@ -0,0 +1,330 @@
+# rotor.py: command layer for the GH RT-21 rotctld axes
+# Written for UCLA's ELFIN mission <elfin.igpp.ucla.edu>
+
+import atexit
+import collections
+import Queue
+import socket
+import threading
+import time
+import clock
+import metrics
+from engine import log
+
+ROTOR_DEADBAND     = 0.25 # degrees, smaller moves are not sent
+ROTOR_MIN_INTERVAL = 0.5  # seconds between commands on one axis
+ROTOR_LAG          = 0.5  # seconds from accepted command to motion
+LATENCY_GAIN       = 0.2  # weight of the newest round trip in the average
+
+ROTOR_TIMEOUT     = 2  # seconds per reply
+ROTOR_MIN_BACKOFF = 1  # seconds before the first reconnect attempt
+ROTOR_MAX_BACKOFF = 30 # seconds, backoff doubles up to this
+
+# One parsed rotctld reply. code is the RPRT code, 0 when the command
+# answered with data instead; values holds that data, e.g. az and el for p.
+Reply = collections.namedtuple("Reply", ["cmd", "code", "values"])
+
+class RotctldError(EnvironmentError):
+    '''A command came back with a non-zero RPRT code'''
+    pass
+
+################################################################################
+class RotctldClient(object):
+    '''Line-framed rotctld connection. The socket is opened on first use
+       and reopened with exponential backoff after a failure. pipeline()
+       writes several commands at once and reads their replies in order,
+       each within timeout seconds.
+    '''
+    # lines in a successful reply, errors are always a single RPRT line
+    REPLY_LINES = {'p': 2, '\\get_pos': 2}
+
+    def __init__(self, host, port, timeout=ROTOR_TIMEOUT):
+        self.host    = host
+        self.port    = port
+        self.timeout = timeout
+        self.sock    = None
+        self.reconnects = 0
+        self._buf    = ''
+        self._backoff = 0
+        self._nextAttempt = 0
+        self._lock   = threading.Lock()
+
+    def connect(self):
+        '''Opens the connection now instead of on the first command,
+           without waiting out the reconnect backoff
+        '''
+        with self._lock:
+            if self.sock is None:
+                self._connect(wait=False)
+
+    def _connect(self, wait=True):
+        now = time.time()
+        if wait and now < self._nextAttempt:
+            raise socket.error("rotctld %s:%d down, retrying in %.1fs"
+                               % (self.host, self.port, self._nextAttempt - now))
+        try:
+            self.sock = socket.create_connection((self.host, self.port),
+                                                 self.timeout)
+        except EnvironmentError:
+            self._backoff = min(max(self._backoff * 2, ROTOR_MIN_BACKOFF),
+                                ROTOR_MAX_BACKOFF)
+            self._nextAttempt = now + self._backoff
+            raise
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._backoff = 0
+        self._buf = ''
+
+    def close(self):
+        with self._lock:
+            self._drop()
+
+    def _drop(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self._buf = ''
+
+    def _readline(self, deadline):
+        while '\n' not in self._buf:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise socket.timeout("rotctld %s:%d reply timed out"
+                                     % (self.host, self.port))
+            self.sock.settimeout(remaining)
+            data = self.sock.recv(1024)
+            if not data:
+                raise socket.error("rotctld %s:%d closed the connection"
+                                   % (self.host, self.port))
+            self._buf += data
+        line, self._buf = self._buf.split('\n', 1)
+        return line.strip()
+
+    def _read(self, cmd, deadline):
+        first = self._readline(deadline)
+        if first.startswith('RPRT'):
+            try:
+                code = int(first.split()[1])
+            except (IndexError, ValueError):
+                # raised as a socket error so pipeline() drops the connection
+                raise socket.error("rotctld %s:%d sent %r"
+                                   % (self.host, self.port, first))
+            return Reply(cmd, code, [])
+        values = [first]
+        for i in range(1, self.REPLY_LINES.get(cmd, 1)):
+            values.append(self._readline(deadline))
+        return Reply(cmd, 0, values)
+
+    def pipeline(self, commands):
+        '''Sends every command in one write and returns one Reply each.
+           Raises EnvironmentError if the connection fails or a reply times
+           out; the connection is then dropped, since late replies would
+           be taken for answers to the next commands.
+        '''
+        with self._lock:
+            try:
+                if self.sock is None:
+                    self._connect()
+                self.sock.sendall(''.join('%s\n' % c for c in commands))
+                replies = []
+                for c in commands:
+                    deadline = time.time() + self.timeout
+                    replies.append(self._read(c.split(' ')[0], deadline))
+                return replies
+            except EnvironmentError:
+                if self.sock is not None:
+                    self.reconnects += 1
+                    metrics.inc("rotor_reconnects_total", port=self.port)
+                self._drop()
+                raise
+
+    def request(self, command):
+        return self.pipeline([command])[0]
+
+    def setPosition(self, az, el=0):
+        '''Returns the RPRT code, 0 if the controller accepted the move'''
+        return self.request('P %.2f %.2f' % (az, el)).code
+
+    def getPosition(self):
+        '''Returns (az, el) in degrees, raises RotctldError on an RPRT'''
+        reply = self.request('p')
+        if reply.code != 0:
+            raise RotctldError(reply.code, "get_pos failed: RPRT %d"
+                               % reply.code)
+        return float(reply.values[0]), float(reply.values[1])
+
+    def stop(self):
+        return self.request('S').code
+
+################################################################################
+class RotorAxis(object):
+    '''One rotctld instance driving one axis. Each RT-21 is set up as an
+       azimuth rotor, so both axes take "P <angle> 0".
+
+       point() drops moves inside the deadband and commands that come
+       sooner than min_interval after the last one. lead() is how far ahead
+       along the trajectory the caller should aim: the measured command
+       round trip plus the controller's lag before it starts moving.
+
+       client may be None while rotctld is still being connected to;
+       point() then returns False until attach() hands over the connection.
+    '''
+    def __init__(self, name, client=None, deadband=ROTOR_DEADBAND,
+                 min_interval=ROTOR_MIN_INTERVAL, lag=ROTOR_LAG):
+        self.name         = name
+        self.client       = client
+        self.deadband     = deadband
+        self.min_interval = min_interval
+        self.lag          = lag
+        self.latency      = 0.0
+        self.lastValue    = None
+        self.lastTime     = 0.0
+        self.sent         = 0
+        self.suppressed   = 0
+        self.errors       = 0
+        self.lastCode     = None # RPRT code of the last command, None if
+                                 # it got no reply
+
+    def lead(self):
+        return self.latency + self.lag
+
+    def attach(self, client):
+        self.client = client
+
+    def point(self, value, now=None, force=False):
+        '''Commands the axis to value (degrees). Returns True if the command
+           was sent and acknowledged, False if it failed or was suppressed.
+           force skips the deadband and rate limit, e.g. for parking.
+        '''
+        if now is None:
+            now = clock.now()
+        if self.client is None:
+            return False
+        if not force:
+            if (self.lastValue is not None and
+                    abs(value - self.lastValue) < self.deadband):
+                self.suppressed += 1
+                metrics.inc("rotor_suppressed_total", axis=self.name)
+                return False
+            if now - self.lastTime < self.min_interval:
+                self.suppressed += 1
+                metrics.inc("rotor_suppressed_total", axis=self.name)
+                return False
+        start = time.time()
+        sim_start = clock.now()
+        try:
+            code = self.client.setPosition(value)
+            error = "RPRT %d" % code
+        except EnvironmentError as e:
+            code = None
+            error = str(e)
+        if metrics.enabled():
+            metrics.observe("rotor_set_position", time.time() - start)
+            metrics.inc("rotor_commands_total", axis=self.name)
+        # lead() is in clock time, which a simulated clock runs faster
+        rtt = clock.now() - sim_start
+        if code is not None:
+            # a timeout says nothing about the round trip, keep it out
+            if self.sent == 0:
+                self.latency = rtt
+                metrics.gauge("startup_seconds", metrics.uptime(),
+                              stage="first_rotor_command", axis=self.name)
+            else:
+                self.latency += LATENCY_GAIN * (rtt - self.latency)
+        self.sent    += 1
+        self.lastTime = now
+        self.lastCode = code
+        if code != 0:
+            self.errors += 1
+            metrics.inc("rotor_rprt_errors_total", axis=self.name)
+            # unknown where the axis ended up, resend next time
+            self.lastValue = None
+            log("rotor " + self.name,
+                "HAMLIB ERROR (%s): %s" % (self.name, error))
+            return False
+        self.lastValue = value
+        return True
+
+    def position(self):
+        '''Returns the angle rotctld reports for the axis in degrees'''
+        if self.client is None:
+            raise socket.error("rotctld %s not connected" % self.name)
+        return self.client.getPosition()[0]
+
+################################################################################
+class _Worker(threading.Thread):
+    '''Runs calls handed to it on one persistent thread, in order'''
+    _all = []
+
+    def __init__(self, name):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self._calls = Queue.Queue()
+        self._all.append(self)
+        self.start()
+
+    @classmethod
+    def stopAll(cls):
+        # a daemon thread still blocked in get() at exit dies noisily
+        for worker in cls._all:
+            worker._calls.put(None)
+        for worker in cls._all:
+            worker.join(1)
+
+    def submit(self, func):
+        '''Queues func. Returns an Event set once it ran and a dict that
+           then holds its "value" or the "error" it raised
+        '''
+        done   = threading.Event()
+        result = {}
+        self._calls.put((func, result, done))
+        return done, result
+
+    def run(self):
+        while True:
+            call = self._calls.get()
+            if call is None:
+                return
+            func, result, done = call
+            try:
+                result["value"] = func()
+            except Exception as e:
+                result["error"] = e
+            done.set()
+
+atexit.register(_Worker.stopAll)
+
+class RotorPair(object):
+    '''Both axes of the array. Every call drives the two rotctld instances
+       at the same time, so it costs one round trip instead of two: the el
+       half runs on a worker thread the pair keeps for its whole life.
+    '''
+    def __init__(self, az, el):
+        self.az = az
+        self.el = el
+        self._worker = None
+        self._lock   = threading.Lock()
+
+    def _both(self, az_func, el_func):
+        with self._lock:
+            if self._worker is None:
+                self._worker = _Worker("rotor %s" % self.el.name.lower())
+        done, result = self._worker.submit(el_func)
+        try:
+            az_result = az_func()
+        finally:
+            done.wait()
+        if "error" in result:
+            raise result["error"]
+        return az_result, result["value"]
+
+    def point(self, az, el, now=None, force=False):
+        '''RotorAxis.point on both axes. Returns (az_ok, el_ok)'''
+        return self._both(lambda: self.az.point(az, now, force),
+                          lambda: self.el.point(el, now, force))
+
+    def position(self):
+        '''Returns (az, el) in degrees as reported by the controllers'''
+        return self._both(self.az.position, self.el.position)
+
+    def connected(self):
+        return self.az.client is not None and self.el.client is not None
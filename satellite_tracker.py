@@ -9,14 +9,27 @@
 # Interface with GPredict removed. Azimuth and elevation from custom tracking script (nostradamus.py) that uses PyEphem.
 
 import socket
-import errno
+import argparse
 import time
+import threading
+import clock
+import metrics
 import nostradamus
+import telemetry
 import signal
 import os.path
-import telnetlib
 import datetime
 from math import *
+from engine import Engine, log
+from rotor import RotctldClient, RotorAxis, RotorPair
+from doppler import DopplerCorrector
+from pathplan import planPass, AZ_LIMITS, EL_LIMITS
+from control import ControlServer, ControlError, CONTROL_SOCKET
+
+#scheduler is imported on first use by load_scheduler, and ahead of that
+#in the background while the operator picks a satellite
+scheduler = None
+scheduler_checked = False
 
 # Constants
 HOST        = 'localhost'
@@ -24,6 +37,11 @@ LOCALHOST   = '127.0.0.1'
 azPORT      = 4535
 elPORT      = 4537
 GQRXPORT    = 7356
+UPLINKPORT  = None #rigctl port of the uplink rig, None if there is none
+#Extra antenna sets next to the one above, as (name, az port, el port, GQRX
+#port, uplink port or None). Each gets its share of the plan, so they need
+#the scheduler and stay idle without numpy/sgp4
+ANTENNAS    = []
 REC_SZ      = 1024
 RUN_FOREVER = True
 LIGHT_SPEED = 299792 #km/s
@@ -31,41 +49,56 @@ LIGHT_SPEED = 299792 #km/s
 
 REQUEST_TIMEOUT = 10 #seconds
 
+PREDICT_PERIOD = 0.5 #seconds between target/position updates
+ROTOR_PERIOD   = 0.1 #seconds between rotor updates, per axis (RotorAxis rate limits)
+DOPPLER_PERIOD = 0.1 #seconds between Doppler updates (10 Hz)
+STATUS_PERIOD  = 5   #seconds between status printouts, None for none
+TELEMETRY_PERIOD = 0.5 #seconds between telemetry records
+
+METRICS_PORT   = 9108 #local Prometheus endpoint, None disables instrumentation
+
+ROTOR_RETRY     = 1  #seconds between rotctld connection attempts
+ROTOR_WAIT      = 5  #seconds an operator command waits for the rotors
+
+RIG_TIMEOUT     = 2  #seconds per GQRX round trip
+RIG_MIN_BACKOFF = 1  #seconds before first reconnect attempt
+RIG_MAX_BACKOFF = 30 #seconds, backoff doubles up to this
+
+PLAN_DAYS    = 1    #days of passes planned at once
+PLAN_REFRESH = 3600 #seconds before the plan runs out to replan
+PREPOSITION  = 300  #seconds before AOS an extra antenna slews to the pass start
+
 AZ_PARK = "130"
 EL_PARK = "90"
 
-###############################################################################
-class client_socket:
-    def __init__(self, sock=None):
-        self.maxRetry  = 5
-        self.retryTime = 1
-        if sock is None:
-            self.sock = socket.socket()
-        else:
-            self.sock = sock
-
-    def connect(self, host, port):
-        for attempt in range(self.maxRetry):
-            try:
-                self.sock.connect((host,port))
-            except EnvironmentError as e:
-                if e.errno == errno.ECONNREFUSED:
-                    time.sleep(self.retryTime)
-                else:
-                    raise
-            else:
-                break
-        else:
-            raise RuntimeError("Maximum number of unsuccessful attempts reached")
+#Center frequencies of satellites we already know, others are asked for
+KNOWN_FREQUENCIES = {
+    "FIREBIRD 4": 437219000, #Hz
+    "CSUNSAT 1":  437400000, #Hz
+    "TIGRISAT":   435000000, #Hz
+    "ESTCUBE 1":  437505000, #Hz
+}
 
-    def send(self, msg):
-        self.sock.send(msg)
+#Priorities in the tracking plan, the higher one wins overlapping passes.
+#Satellites not listed get 0; --priority and the control socket add more
+PRIORITIES = {}
 
-    def get_response(self):
-        return self.sock.recv(REC_SZ)
+#Guards the satellite and frequency lists and the target while the predict
+#task or a control socket command changes them
+state_lock = threading.RLock()
+#Snapshot of the tracker published every predict tick for status queries
+tracker_state = {}
+#Pass table of the target and the rotor path planned over it, replaced by
+#the predict task and only read by the rotor tasks
+traj = None
+path = None
+#Range rate and center frequency of the target, read by the radio task,
+#which may run before the predict task first sets them
+vel = 0
+FREQUENCY = None
+#Extra antenna sets, see ANTENNAS
+antennas = []
 
-    def __del__(self):
-        self.sock.close()
 ##############################################################################
 class AlarmException(Exception):
     pass
@@ -73,11 +106,16 @@ class AlarmException(Exception):
 def alarmHandler(signum, frame):
     raise AlarmException
 
+@metrics.timed("input_prompt")
 def new_command_request(prompt = '\nEnter "S" to switch satellites, "C" to change command, do nothing to continue: ', timeout = REQUEST_TIMEOUT):
+    global user_choice
+    if timeout is None:
+        #blocking raw input, only safe off the tracking threads
+        user_choice = raw_input(prompt)
+        return user_choice
     #non-blocking raw input (issues with blocking interruption)
     signal.signal(signal.SIGALRM, alarmHandler)
     signal.alarm(timeout)
-    global user_choice
     user_choice = ''
     try:
         user_choice = raw_input(prompt)
@@ -105,18 +143,95 @@ def new_command_execute(user_input):
 
 ###############################################################################
 class RadioControl():
-    """Basic rigctl client implementation."""
+    """Basic rigctl client implementation.
+
+    Keeps one connection to GQRX open for its whole life. Replies are framed
+    by line, a dropped connection is reopened with exponential backoff, and
+    pipeline() sends several commands in one write.
+    """
+
+    # replies that span more than one line, everything else is one line
+    REPLY_LINES = {'m': 2}
 
-    def __init__(self, hostname=LOCALHOST, port=GQRXPORT):
+    def __init__(self, hostname=LOCALHOST, port=GQRXPORT, timeout=RIG_TIMEOUT):
         self.hostname = hostname
         self.port = port
+        self.timeout = timeout
+        self.sock = None
+        self._buf = ''
+        self._backoff = 0
+        self._nextAttempt = 0
+        self._lock = threading.Lock()
+        self.reconnects = 0
+
+    def _connect(self):
+        now = time.time()
+        if now < self._nextAttempt:
+            raise socket.error("rigctl %s:%d down, retrying in %.1fs"
+                               % (self.hostname, self.port,
+                                  self._nextAttempt - now))
+        try:
+            self.sock = socket.create_connection((self.hostname, self.port),
+                                                 self.timeout)
+        except EnvironmentError:
+            self._backoff = min(max(self._backoff * 2, RIG_MIN_BACKOFF),
+                                RIG_MAX_BACKOFF)
+            self._nextAttempt = now + self._backoff
+            raise
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._backoff = 0
+        self._buf = ''
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.sendall('q\n'.encode('ascii'))
+            except EnvironmentError:
+                pass
+            self.sock.close()
+        self.sock = None
+
+    def _readline(self):
+        while '\n' not in self._buf:
+            data = self.sock.recv(REC_SZ)
+            if not data:
+                raise socket.error("rigctl connection closed")
+            self._buf += data.decode('ascii')
+        line, self._buf = self._buf.split('\n', 1)
+        return line.strip()
+
+    @metrics.timed("gqrx_request")
+    def _exchange(self, requests):
+        if self.sock is None:
+            self._connect()
+        self.sock.sendall(''.join('%s\n' % r for r in requests).encode('ascii'))
+        responses = []
+        for request in requests:
+            lines = self.REPLY_LINES.get(request.split(' ')[0], 1)
+            reply = [self._readline() for i in range(lines)]
+            if reply[0].startswith('RPRT'):
+                # errors come back as a single RPRT line whatever was asked
+                reply = reply[:1]
+            responses.append('\n'.join(reply))
+        return responses
+
+    def pipeline(self, requests):
+        """Sends all requests in one write, returns one reply per request."""
+        with self._lock:
+            try:
+                return self._exchange(requests)
+            except EnvironmentError:
+                if self.sock is None:
+                    raise
+                # stale connection, reopen once and replay the batch
+                self.sock.close()
+                self.sock = None
+                self.reconnects += 1
+                metrics.inc("gqrx_reconnects_total")
+                return self._exchange(requests)
 
     def _request(self, request):
-        con = telnetlib.Telnet(self.hostname, self.port)
-        con.write(('%s\n' % request).encode('ascii'))
-        response = con.read_some().decode('ascii').strip()
-        con.write('c\n'.encode('ascii'))
-        return response
+        return self.pipeline([request])[0]
 
     def set_frequency(self, frequency):
         return self._request('F %s' % frequency)
@@ -132,217 +247,631 @@ class RadioControl():
 
     def get_level(self):
         return self._request('l')
+
+    def __del__(self):
+        self.close()
 ###############################################################################
-def main():
+class Antenna(object):
+    """One extra antenna set: an az/el rotctld pair and its own radio.
 
-#Creates sockets for az and el of rotor controller
-    global az
-    global el
-    try:
-        az       = client_socket()
-        el       = client_socket()
-    except Exception as e:
-        print "Could not make sockets. Exiting."
-        print e
-        sys.exit(1)
-    az.connect(HOST, azPORT)
-    el.connect(HOST, elPORT)
-    print "Connected to rotctld instances."
-#Initialize radio controller
+    Prediction stays shared. The predict task gives each antenna its target
+    from the antenna's share of the plan, and plans its rotor path; the
+    antenna's rotor and radio tasks then run on their own threads, so a slow
+    set does not hold up the others.
+    """
+
+    def __init__(self, name, az_port, el_port, radio_port, uplink_port=None):
+        self.name = name
+        self.az_port = az_port
+        self.el_port = el_port
+        self.az_axis = RotorAxis("%s AZ" % name)
+        self.el_axis = RotorAxis("%s EL" % name)
+        self.rotors = RotorPair(self.az_axis, self.el_axis)
+        self.connected = threading.Event()
+        self.radio = RadioControl(port=radio_port)
+        uplink_radio = None
+        if uplink_port is not None:
+            uplink_radio = RadioControl(port=uplink_port)
+        self.doppler = DopplerCorrector(self.radio, uplink_radio)
+        self.plan = None
+        self.target = None
+        self.frequency = None
+        self.traj = None
+        self.path = None
+        self.pos = None
+        self.vel = 0
+        self.in_range = False
+
+    def connect(self):
+        """Connects both rotctld instances in the background"""
+        for axis, port in ((self.az_axis, self.az_port),
+                           (self.el_axis, self.el_port)):
+            background("connect %s" % axis.name.lower(),
+                       lambda axis=axis, port=port:
+                       connect_rotor(axis, port, self.rotors, self.connected))
+
+    def update(self, table, now):
+        """Picks the target from this antenna's plan and predicts it. Runs
+        on the predict task, which owns the shared predictor."""
+        entry = self.plan.target(now) if self.plan is not None else None
+        sat = None
+        if entry is not None and entry.sat in satellite_list:
+            sat = entry.sat
+        if sat != self.target:
+            self.traj = self.path = None
+        self.target = sat
+        if sat is None:
+            self.in_range = False
+            return
+        self.frequency = frequency_list[satellite_list.index(sat)]
+        new_traj = n.trajectory(sat, now)
+        if new_traj is None:
+            self.path = None
+        elif new_traj is not self.traj or self.path is None:
+            self.path = planPass(new_traj, axis_position(self.az_axis,
+                                                         self.el_axis))
+        self.traj = new_traj
+        if new_traj is not None and new_traj.covers(now):
+            az, el, self.vel = new_traj.at(now)
+        elif sat in table.names:
+            i = table.names.index(sat)
+            az, el, self.vel = table.az[i], table.el[i], table.range_rate[i]
+        else:
+            state = n.state(sat, now)
+            az, el, self.vel = state.az, state.el, state.range_rate
+        self.pos = (az, el)
+        self.in_range = el >= 0
+
+    def track(self, rotor, axis):
+        """Rotor task for one axis. Follows the planned path in pass and
+        waits at its start once AOS is PREPOSITION seconds away"""
+        if selection != 'P' or self.pos is None:
+            return
+        now = clock.now()
+        table = self.path
+        if self.in_range:
+            aim_axis(rotor, axis, table, self.pos[axis], now)
+        elif table is not None and 0 < table.start - now <= PREPOSITION:
+            #deadband keeps this from resending every tick
+            rotor.point((table.az, table.el)[axis][0], now)
+
+    def tune(self):
+        """Radio task, Doppler correction for the target"""
+        if self.target is None:
+            return
+        sat = n.getSatellite(self.target)
+        uplink = sat.uplinkHz() if sat else None
+        self.doppler.update(self.frequency, uplink,
+                            range_rate(self.traj, self.vel, clock.now()))
+
+    def park(self):
+        az_ok, el_ok = self.rotors.point(float(AZ_PARK), float(EL_PARK),
+                                         force=True)
+        return az_ok and el_ok
+
+    def state(self):
+        """What the predict task last worked out, for publish_state"""
+        state = {"name": self.name,
+                 "target": self.target,
+                 "in_range": self.in_range,
+                 "connected": self.rotors.connected()}
+        if self.target is not None and self.pos is not None:
+            state.update({"az": float(self.pos[0]), "el": float(self.pos[1]),
+                          "range_rate": float(self.vel),
+                          "frequency": self.frequency,
+                          "downlink": self.doppler.downlink,
+                          "uplink": self.doppler.uplink,
+                          "rotor_mode": self.path.mode if self.path else None})
+        return state
+
+###############################################################################
+def main(daemon=False, satellites=(), engage=False,
+         control_socket=CONTROL_SOCKET, status_period=STATUS_PERIOD,
+         telemetry_dir=telemetry.TELEMETRY_DIR, antenna_sets=None,
+         priorities=None):
+    if METRICS_PORT is not None:
+        try:
+            metrics.serve(METRICS_PORT)
+        except socket.error as e:
+            #tracking matters more than its instrumentation
+            print "Metrics disabled, port %d unavailable: %s" % (METRICS_PORT, e)
+
+#Slow startup work runs in the background so prediction starts from the
+#cached tle.txt right away: the scheduler import and the rotctld
+#connections. Each rotor axis takes commands as soon as it is connected
+    background("import scheduler", load_scheduler)
+    global az_axis
+    global el_axis
+    global rotors
+    global rotors_connected
+    az_axis = RotorAxis("AZ")
+    el_axis = RotorAxis("EL")
+    rotors = RotorPair(az_axis, el_axis)
+    rotors_connected = threading.Event()
+    background("connect az", lambda: connect_rotor(az_axis, azPORT))
+    background("connect el", lambda: connect_rotor(el_axis, elPORT))
+    global antennas
+    if antenna_sets is None:
+        antenna_sets = ANTENNAS
+    antennas = [Antenna(*spec) for spec in antenna_sets]
+    for antenna in antennas:
+        antenna.connect()
+#Initialize radio controller. Connects on first use
     global r
+    global doppler
     r = RadioControl()
+    uplink_radio = None
+    if UPLINKPORT is not None:
+        uplink_radio = RadioControl(port=UPLINKPORT)
+    doppler = DopplerCorrector(r, uplink_radio)
 #Initialize nostradamus
     global n
     n = nostradamus.Predictor()
 
-#Update TLEs before starting
-    n.updateTLEs()
+#Update TLEs before starting. Only blocks if there is no cached tle.txt,
+#otherwise the refresher keeps it current in the background
+    global refresher
+    refresher = nostradamus.TLERefresher(n)
+    if not os.path.exists(refresher.filename):
+        print "No cached TLEs, downloading..."
+        n.updateTLEs()
+    refresher.start()
+    startup_stage("tle_ready")
+#Plan priorities from the command line, under the names the predictor uses
+    for sat, priority in (priorities or {}).items():
+        PRIORITIES[resolve_satellite(sat) or sat] = priority
 #Lists needed to track multiple satellites. Initialize empty before loop
     global satellite_list
     global frequency_list
     satellite_list = []
     frequency_list = []
-#Choose satellite to track and command to send to rotor controller
-    select_satellite()
-    command_request()
+#Choose satellite to track and command to send to rotor controller.
+#Headless, they come from the command line and the control socket instead
+    global satellite
+    global selection
+    global IN_RANGE
+    if daemon:
+        satellite = None
+        IN_RANGE = False
+        for sat, freq in satellites:
+            try:
+                if not add_satellite(sat, freq):
+                    print "Not tracking %s, no TLE found." % sat
+            except ValueError as e:
+                print "Not tracking %s, %s." % (sat, e)
+        selection = 'P' if engage else 'p'
+    else:
+        select_satellite()
+        command_request()
     global SATELLITE
     global SATELLITE_SELECTED
+    global doppler_corrected_freq
+    doppler_corrected_freq = 0
 #TODO: function for doppler frequency. If sats in list not in range, do not set frequency in gqrx
 
-#Loop 2: IN_RANGE -> starts tracking
-#Loop 1: not IN_RANGE -> will print pos and keep checking for LOS.
-#When AOS established, loop 2 runs. When AOS lost, loop 1 runs.
-#RUN_FOREVER keeps the script switching between loop 1 and 2
+#Prediction, each rotor axis, the radio, status output and operator input
+#each run on their own thread and cadence. Tracking never waits on input.
+    global engine
+    engine = Engine()
+    predict_tick()
+    startup_stage("first_prediction")
+    engine.every("predict", PREDICT_PERIOD, predict_tick)
+    engine.every("rotor az", ROTOR_PERIOD, lambda: track_axis(az_axis, 0))
+    engine.every("rotor el", ROTOR_PERIOD, lambda: track_axis(el_axis, 1))
+    engine.every("radio", DOPPLER_PERIOD, doppler_tick)
+    for antenna in antennas:
+        engine.every("rotor az %s" % antenna.name, ROTOR_PERIOD,
+                     lambda a=antenna: a.track(a.az_axis, 0))
+        engine.every("rotor el %s" % antenna.name, ROTOR_PERIOD,
+                     lambda a=antenna: a.track(a.el_axis, 1))
+        engine.every("radio %s" % antenna.name, DOPPLER_PERIOD, antenna.tune)
+    if status_period:
+        engine.every("status", status_period, status_tick)
+    global telemetry_log
+    telemetry_log = None
+    if telemetry_dir:
+        telemetry_log = telemetry.TelemetryLog(telemetry_dir, n.getStation())
+        engine.every("telemetry", TELEMETRY_PERIOD, telemetry_tick)
+    control_server = None
+    if daemon:
+        control_server = ControlServer(CONTROL_COMMANDS, control_socket)
+        engine.spawn("control", control_server.serve_forever)
+        print "Listening for commands on %s" % control_socket
+    else:
+        engine.spawn("input", operator_input)
+    engine.start()
+    try:
+        engine.wait()
+    finally:
+        if control_server is not None:
+            control_server.close()
+        if telemetry_log is not None:
+            telemetry_log.close()
+        refresher.stop()
 
-    while RUN_FOREVER:
+#Runs func once on a daemon thread, for startup work nothing waits on
+def background(name, func):
+    thread = threading.Thread(target=func, name=name)
+    thread.daemon = True
+    thread.start()
+    return thread
 
-        print "\n______________Listening to Nostradamus______________"
-#Prints current station and satellite. Optional to set station through nostradamus function
-        print "\nSTATION: " + n.getStation()
-        print "SATELLITES: " + str(n.getSatellites()) + "\n"
-        #print satellite_list
-        SATELLITE_SELECTED = None
-        SATELLITE = satellite
+#Returns the scheduler module, or None without numpy/sgp4. In that case
+#the target is picked every tick instead
+def load_scheduler():
+    global scheduler
+    global scheduler_checked
+    if not scheduler_checked:
+        try:
+            import scheduler as module
+        except ImportError:
+            module = None
+        scheduler = module
+        scheduler_checked = True
+    return scheduler
 
-#Select satellite from list that is in range.
-#Pass if none in range. Defaults to select_satellite input until new satellite in range
-        global pos_list
-        global vel_list
+#Connects one rotctld instance, retrying until it is up, then hands the
+#connection to the axis. pair and connected default to the main antenna's
+def connect_rotor(axis, port, pair=None, connected=None):
+    if pair is None:
+        pair, connected = rotors, rotors_connected
+    client = RotctldClient(HOST, port)
+    while True:
+        try:
+            client.connect()
+            break
+        except EnvironmentError as e:
+            log("connect " + axis.name, "rotctld %s on port %d not up yet: %s"
+                % (axis.name, port, e))
+            time.sleep(ROTOR_RETRY)
+    axis.attach(client)
+    startup_stage("%s_connected" % axis.name.lower())
+    if pair.connected():
+        print "Connected to rotctld instances."
+        connected.set()
+
+#Records how many seconds after start a startup stage was reached
+def startup_stage(stage):
+    metrics.gauge("startup_seconds", metrics.uptime(), stage=stage)
+
+#Selects target, computes its position and checks AOS/LOS
+@metrics.timed("predict_tick")
+def predict_tick():
+    with state_lock:
+        predict_target()
+        publish_state()
+
+def predict_target():
+    global SATELLITE
+    global SATELLITE_SELECTED
+    global FREQUENCY
+    global pos_list
+    global vel_list
+    global IN_RANGE
+    global traj
+    global path
+    SATELLITE_SELECTED = None
+    SATELLITE = satellite
+    if not satellite_list:
+        #headless with nothing to track yet
         pos_list = []
         vel_list = []
-        for i in range(0, len(satellite_list)):
-            satellite_pos_generator(satellite_list[i])
-            satellite_switcher(pos_list[i], satellite_list[i])
+        IN_RANGE = False
+        traj = None
+        path = None
+        return
 
-        if SATELLITE_SELECTED is True:
-            print "%s HAS BEEN SELECTED.\n" % SATELLITE
-        else:
-            print "All satellites in list out of range. \n"
+#Select satellite from list that is in range.
+#Pass if none in range. Defaults to select_satellite input until new satellite in range
+#With a plan, choosing the target takes no prediction. What still runs every
+#tick feeds the position readouts: one vectorized snapshot of all sats for
+#the status and state, and the target's pass table and nextpass, both cached
+    table = n.snapshot_all()
+    new_pos = []
+    new_vel = []
+    for i in range(0, len(satellite_list)):
+        satellite_pos_generator(satellite_list[i], table, new_pos, new_vel)
+    pos_list = new_pos
+    vel_list = new_vel
+    if load_scheduler() is not None:
+        follow_plan()
+    else:
+        satellite_switcher(table)
+    now = clock.now()
+    for antenna in antennas:
+        antenna.update(table, now)
+    if SATELLITE is None:
+        #free until the next pass in its plan
+        IN_RANGE = False
+        traj = None
+        path = None
+        return
 
 #Grab index of selected satellite. Used to pick corresponding frequency from list.
-        if SATELLITE in satellite_list:
-            sat_index = satellite_list.index(SATELLITE)
+    if SATELLITE in satellite_list:
+        sat_index = satellite_list.index(SATELLITE)
         FREQUENCY = frequency_list[sat_index]
 #Compute pos and put into rotorcmd
-        start_tracker(SATELLITE)
+    start_tracker(SATELLITE)
+
+#Check if satellite is in LOS to determine loop entry
+    check_AOS(SATELLITE, pos, quiet=True)
+
+#Point to rise azimuth of upcoming satellite 5 mins before AOS
+    get_countdown_secs(SATELLITE, quiet=True)
+    if 240 <= sec_to_AOS <= 300 and not IN_RANGE:
+        set_rise_azimuth(SATELLITE)
+
+#Points one rotor axis while tracking is engaged. Aims rotor.lead() seconds
+#ahead on the planned path to make up for command-to-motion latency
+def track_axis(rotor, axis):
+    if selection != 'P' or not IN_RANGE:
+        return
+    cmd = rotorcmd.split(',')
+    # cmd = [P, AZIMUTH, ELEVATION]
+    aim_axis(rotor, axis, path, float(cmd[1 + axis]), clock.now())
+
+#Points rotor at axis of the planned path table, or at fallback off the
+#path. Past the end of the table at() holds the last planned pose; the raw
+#angles could be the other way round when the pass is flown flipped
+def aim_axis(rotor, axis, table, fallback, now):
+    ahead = now + rotor.lead()
+    if table is not None and (table.covers(now) or table.covers(ahead)):
+        value = table.at(ahead)[axis]
+    else:
+        value = fallback
+    #az may go below 0 on purpose, see pathplan
+    low, high = (AZ_LIMITS, EL_LIMITS)[axis]
+    rotor.point(min(max(value, low), high), now)
+
+#Range rate from the pass table, or fallback off the table
+def range_rate(table, fallback, now):
+    if table is not None and table.covers(now):
+        return table.at(now)[2]
+    return fallback
+
+#Where the axes were last commanded as (az, el), None before the first command
+def axis_position(az, el):
+    if az.lastValue is None or el.lastValue is None:
+        return None
+    return (az.lastValue, el.lastValue)
 
 #Doppler shifted frequency tracked and set in GQRX via port
 # -vel shift right, +vel shift left
-        shift = doppler_shift(FREQUENCY)
-        doppler_corrected_freq = int(FREQUENCY - shift)
-        r.set_frequency(doppler_corrected_freq)
+#Range rate is interpolated from the pass table, so retunes can run far
+#faster than the predict task
+@metrics.timed("doppler_tick")
+def doppler_tick():
+    global doppler_corrected_freq
+    if SATELLITE is None:
+        return
+    sat = n.getSatellite(SATELLITE)
+    uplink = sat.uplinkHz() if sat else None
+    down, up = doppler.update(FREQUENCY, uplink,
+                              range_rate(traj, vel, clock.now()))
+    doppler_corrected_freq = down
 
-#Check if satellite is in LOS to determine loop entry
-        check_AOS(SATELLITE, pos)
+#Records what was commanded, where the array reads back, the range rate and
+#the tuned frequency. Replaces reading the console for post-pass analysis
+@metrics.timed("telemetry_tick")
+def telemetry_tick():
+    now = clock.now()
+    rate = None
+    if SATELLITE is not None:
+        rate = range_rate(traj, vel, now)
+    record_antenna(now, 0, rotors, SATELLITE, IN_RANGE, rate, doppler)
+    for i, antenna in enumerate(antennas):
+        rate = None
+        if antenna.target is not None:
+            rate = range_rate(antenna.traj, antenna.vel, now)
+        record_antenna(now, i + 1, antenna.rotors, antenna.target,
+                       antenna.in_range, rate, antenna.doppler)
 
-#Point to rise azimuth of upcoming satellite 5 mins before AOS
-        get_countdown_AOS(SATELLITE)
-        get_countdown_secs(SATELLITE)
-        if 240 <= sec_to_AOS <= 300:
-            set_rise_azimuth(SATELLITE)
-
-        while IN_RANGE is False:
-            for i in range(0, len(satellite_list)):
-                check_satellite(satellite_list[i], pos_list[i], doppler_corrected_freq, frequency_list[i])
-            command_execute()
-            new_command_request()
-            new_command_execute(user_choice)
-            break
+def record_antenna(now, index, pair, sat, in_range, rate, corrector):
+    az = el = None
+    if pair.connected():
+        try:
+            az, el = pair.position()
+        except EnvironmentError:
+            pass
+    flags = 0
+    if selection == 'P':
+        flags |= telemetry.ENGAGED
+    if in_range:
+        flags |= telemetry.IN_RANGE
+    if pair.connected():
+        flags |= telemetry.CONNECTED
+    telemetry_log.record(now, sat, pair.az.lastValue, pair.el.lastValue,
+                         az, el, rate, corrector.downlink,
+                         rotor_code(pair.az), rotor_code(pair.el), flags,
+                         index)
 
-        while IN_RANGE is True:
-            check_satellite(SATELLITE, pos, doppler_corrected_freq, FREQUENCY)
-            command_execute()
-            new_command_request()
-            new_command_execute(user_choice)
-            break
+def rotor_code(axis):
+    if axis.sent == 0:
+        return telemetry.CODE_NONE
+    return axis.lastCode
 
-        time.sleep(.5) #seconds
+@metrics.timed("status_tick")
+def status_tick():
+    print "\n______________Listening to Nostradamus______________"
+#Prints current station and satellite. Optional to set station through nostradamus function
+#The GQRX round trip stays outside the lock, so predict never waits on it.
+#The predictor calls below share its observer with the predict task
+    tuned = r.get_frequency() if satellite_list else None
+    with state_lock:
+        print "\nSTATION: " + n.getStation()
+        print "SATELLITES: " + str(n.getSatellites()) + "\n"
+        if SATELLITE_SELECTED is True:
+            print "%s HAS BEEN SELECTED.\n" % SATELLITE
+        else:
+            print "All satellites in list out of range. \n"
+        if IN_RANGE:
+            check_satellite(SATELLITE, pos, doppler_corrected_freq, FREQUENCY,
+                            tuned)
+        else:
+            positions = pos_list
+            for i in range(0, len(positions)):
+                check_satellite(satellite_list[i], positions[i], doppler_corrected_freq, frequency_list[i], tuned)
+        for antenna in antennas:
+            if antenna.target is None:
+                print "ANTENNA %s: free" % antenna.name
+            elif antenna.in_range:
+                print "ANTENNA %s: tracking %s at AZ %.2f EL %.2f" % (
+                    antenna.name, antenna.target, antenna.pos[0], antenna.pos[1])
+            else:
+                print "ANTENNA %s: awaiting AOS of %s" % (antenna.name,
+                                                          antenna.target)
+
+#Operator commands. Blocks on raw_input on its own thread only
+def operator_input():
+    while engine.running():
+        try:
+            new_command_request(timeout=None)
+        except EOFError:
+            #no console, keep tracking unattended
+            return
+        new_command_execute(user_choice)
+        command_execute()
 
 
 def command_execute():
     if selection == 'q':
         print "\nSHUTTING DOWN DEATHSTAR."
-        quit()
+        engine.stop()
     elif selection == 'p':
-        get_position(az, el)
+        get_position()
     elif selection == 'P' and IN_RANGE:
-        valid_set = set_position(az, el, rotorcmd)
-        get_position(az, el)
-        '''
-        if not valid_set:
-            print "%s out of range. Exiting." % satellite
-            break
-        '''
+        #rotor tasks keep the array on target
+        get_position()
+    elif selection == 'P':
+        print "\nTracking engaged, waiting for AOS."
     elif selection == 'Q':
         print "\nParking the deathstar...\n"
-        set_parking(az, el, rotorcmd)
-        quit()
+        set_parking()
+        engine.stop()
     else:
         print "\nTracking not engaged."
 
-def get_position(az, el):
+@metrics.timed("rotor_get_position")
+def get_position():
     print "\nRequesting array position... "
-    azCtrl = 'p' + ' ' + '0' + ' 0\n'
-    az.send(azCtrl)
-    az_response = az.get_response().splitlines()[0]
-    elCtrl = 'p' + ' ' + '0' + ' 0\n'
-    el.send(elCtrl)
-    el_response = el.get_response().splitlines()[0]
-    response = "\nAZ: " + az_response + '\n' + "EL: "+  el_response + '\n'
-    print "Response: " + response
-
-def set_position(az, el, cmd):
+    if not rotors_connected.wait(ROTOR_WAIT):
+        print "Rotors not connected yet."
+        return
+    try:
+        az_pos, el_pos = read_position()
+    except EnvironmentError as e:
+        print "HAMLIB ERROR: %s" % e
+        return
+    print "Response: \nAZ: %.2f\nEL: %.2f\n" % (az_pos, el_pos)
+
+#Returns (az, el) in degrees as reported by rotctld, both axes at once
+def read_position():
+    return rotors.position()
+
+def set_position(cmd):
     print "\nAiming array..."
     cmd  = cmd.split(',')
     # cmd = [P, AZIMUTH, ELEVATION]
-    azCtrl = cmd[0] + ' ' + cmd[1] + ' 0\n'
-    az.send(azCtrl)
-    if float(cmd[2]) < 0:
-        cmd[2] = '0'
-    elCtrl = cmd[0] + ' ' + cmd[2] + ' 0\n'
-    el.send(elCtrl)
-    print "Commands sent."
-    print "AZ: " + azCtrl
-    print "EL: " + elCtrl
-    az_resp = az.get_response()
-    el_resp = el.get_response()
-    print "Checking array..."
-    #print "AZ: " + az_resp
-    #print "EL: " + el_resp
-    if az_resp == el_resp and az_resp == "RPRT 0\n":
-        pass
-    else:
+    az_ok, el_ok = rotors.point(float(cmd[1]), max(float(cmd[2]), 0.0),
+                                force=True)
+    if not (az_ok and el_ok):
         print "HAMLIB ERROR."
         return 0
 
-def set_parking(az, el, cmd):
+def set_parking():
     print "___Setting Position___ "
     print "AZ: " +  AZ_PARK + "\nEL: " + EL_PARK
-    azCtrl = "P" + ' ' + AZ_PARK + ' 0\n'
-    az.send(azCtrl)
-    elCtrl = "P" + ' ' + EL_PARK + ' 0\n'
-    el.send(elCtrl)
-    az_resp = az.get_response()
-    el_resp = el.get_response()
-    if az_resp == el_resp and az_resp == "RPRT 0\n":
+    az_ok, el_ok = rotors.point(float(AZ_PARK), float(EL_PARK), force=True)
+    parked = az_ok and el_ok
+    for antenna in antennas:
+        if not antenna.park():
+            print "Couldnt park antenna %s" % antenna.name
+            parked = False
+    if parked:
         print "Deathstar succesfully parked..."
-        pass
     else:
-        print("Couldnt park deathstar :( ", az_resp, el_resp)
+        print "Couldnt park deathstar :( "
+    return parked
 
+#Asks for a satellite and, unless it is known, its frequency. Nothing is
+#changed until both are in, so the prompts never hold up tracking
 def select_satellite():
+    global satellite
     while True:
-        global satellite
-        satellite = raw_input("Which satellite would you like to track? ")
-        if satellite not in satellite_list:
-            satellite_list.append(satellite)
-        else:
-            print "%s already in list." % satellite
-        valid = n.addSatellite(satellite)
-        if(valid):
-            select_frequency()
-            break
-        else:
+        sat = raw_input("Which satellite would you like to track? ")
+        with state_lock:
+            name = resolve_satellite(sat)
+            if name in satellite_list:
+                print "%s already in list." % name
+                satellite = name
+                return
+        if name is None:
             #check if spelling is correct or if satellite is in tle.txt
             print "Please enter valid satellite."
+            continue
+        try:
+            if add_satellite(sat, select_frequency(name)):
+                return
+        except ValueError as e:
+            print "Not tracking %s, %s." % (name, e)
 
-def select_frequency():
-    global frequency
-    if satellite == "FIREBIRD 4":
-        frequency = 437219000 #Hz
-    elif satellite == "CSUNSAT 1":
-        frequency = 437400000 #Hz
-    elif satellite == "TIGRISAT":
-        frequency = 435000000 #Hz
-    elif satellite == "ESTCUBE 1":
-        frequency = 437505000 #Hz
-    else:
-        frequency =raw_input("Enter center frequency: ")
-        frequency = int(frequency)
-    if frequency not in frequency_list:
-        frequency_list.append(frequency)
-    else:
-        print "Frequency already in list."
+def select_frequency(sat):
+    if sat in KNOWN_FREQUENCIES:
+        return KNOWN_FREQUENCIES[sat]
+    while True:
+        try:
+            return int(raw_input("Enter center frequency: "))
+        except ValueError:
+            print "Please enter the frequency in Hz."
+
+#Name the predictor tracks sat under, which may also be a NORAD number or
+#designator. None if there is no TLE for sat
+def resolve_satellite(sat):
+    body = n.loadTLE(str(sat))
+    return body.name if body else None
+
+#Non-interactive select_satellite/select_frequency. sat may be a name, NORAD
+#number or designator. Returns the name the predictor tracks it under, None
+#if there is no TLE for sat. Raises ValueError if it cannot be tracked
+def add_satellite(sat, freq=None):
+    global satellite
+    sat = str(sat)
+    if freq is not None:
+        freq = int(freq)
+    with state_lock:
+        #everything is checked before the predictor is touched
+        name = resolve_satellite(sat)
+        if name is None:
+            return None
+        if name in satellite_list:
+            raise ValueError("already tracking %s" % name)
+        if freq is None:
+            freq = KNOWN_FREQUENCIES.get(name, KNOWN_FREQUENCIES.get(sat))
+        if freq is None:
+            raise ValueError("no known frequency for %s" % name)
+        if not n.addSatellite(sat):
+            return None
+        name = n.getSatellites()[-1]
+        satellite_list.append(name)
+        frequency_list.append(freq)
+        satellite = name
+        update_plan()
+    return name
+
+def remove_satellite(sat):
+    global satellite
+    with state_lock:
+        if sat not in satellite_list:
+            return False
+        i = satellite_list.index(sat)
+        del satellite_list[i]
+        del frequency_list[i]
+        n.removeSatellite(sat)
+        if satellite == sat:
+            satellite = satellite_list[-1] if satellite_list else None
+        update_plan()
+    return True
 
 def command_request():
     while True:
@@ -355,51 +884,48 @@ def command_request():
             break
 
 def get_time_now():
-    utc_now = datetime.datetime.utcnow().strftime("%H:%M:%S (UTC)")
+    utc_now = clock.utcnow().strftime("%H:%M:%S (UTC)")
     return utc_now
 
 def get_countdown_AOS(sat):
         AOS = str(n.nextpass(sat)[0])
         AOS_datetime_object = datetime.datetime.strptime(AOS,'%Y/%m/%d %H:%M:%S')
-        NOW = datetime.datetime.utcnow()
+        NOW = clock.utcnow()
         time_to_AOS = str(AOS_datetime_object - NOW).split('.')[0]
         return time_to_AOS
 
 def get_countdown_LOS(sat):
         LOS = str(n.nextpass(sat)[4])
         LOS_datetime_object = datetime.datetime.strptime(LOS,'%Y/%m/%d %H:%M:%S')
-        NOW = datetime.datetime.utcnow()
+        NOW = clock.utcnow()
         time_to_LOS = str(LOS_datetime_object - NOW).split('.')[0]
         return time_to_LOS
 
-def get_countdown_secs(sat):
+def get_countdown_secs(sat, quiet=False):
         global sec_to_AOS
         check_pass = n.nextpass(sat)
         AOS = str(check_pass[0])
         AOS_datetime_object = datetime.datetime.strptime(AOS,'%Y/%m/%d %H:%M:%S')
-        NOW = datetime.datetime.utcnow()
+        NOW = clock.utcnow()
         sec_to_AOS = (AOS_datetime_object - NOW).total_seconds()
         sec_to_AOS = str(sec_to_AOS).split('.')[0]
-        print sec_to_AOS
+        if not quiet:
+            print sec_to_AOS
         sec_to_AOS = float(sec_to_AOS)
         return sec_to_AOS
 
 def set_rise_azimuth(sat):
-        RISE_AZ = '%.2f' % degrees(passinfo[1])
-        RISE_EL = '0'
-        azCtrl = "P" + ' ' + RISE_AZ + ' 0\n'
-        elCtrl = "P" + ' ' + RISE_EL + ' 0\n'
-        az.send(azCtrl)
-        el.send(elCtrl)
-        az_resp = az.get_response()
-        el_resp = el.get_response()
-        if az_resp == el_resp and az_resp == "RPRT 0\n":
+        RISE_AZ = degrees(passinfo[1])
+        RISE_EL = 0
+        if path is not None and path.start > clock.now():
+            #where the planned path starts, which may be flipped over the top
+            RISE_AZ, RISE_EL = path.az[0], path.el[0]
+        #deadband keeps this from resending every tick of the window
+        az_ok, el_ok = rotors.point(RISE_AZ, RISE_EL)
+        if az_ok and el_ok:
             print "Now pointing at rise azimuth of %s\n" % sat
-            pass
-        else:
-            print("Something wrong? idk check", az_resp, el_resp)
 
-def check_satellite(sat, position, doppler_freq, center_freq):
+def check_satellite(sat, position, doppler_freq, center_freq, tuned):
         check =  position.split(',')
         check_az = '%.2f' % float(check[0])
         check_el = '%.2f' % float(check[1])
@@ -417,57 +943,257 @@ def check_satellite(sat, position, doppler_freq, center_freq):
         #print "Rise azimuth: %s" % ('%.2f' % degrees(check_passinfo[1]))
         print "Frequency: %s Hz" % str(center_freq)
         #print "Doppler Shifted Frequency: %s Hz" % str(doppler_freq)
-        print "GQRX (doppler corrected) Frequency: " + r.get_frequency() + " Hz\n"
+        print "GQRX (doppler corrected) Frequency: " + tuned + " Hz\n"
 
-def check_AOS(sat, position):
+def check_AOS(sat, position, quiet=False):
         #checks if satellite is above horizon. If below horizon, az can be set but not el
         check =  position.split(',')
         check_az = float(check[0])
         check_el = float(check[1])
         global IN_RANGE
         if check_el < 0:
-            print "%s currently below horizon. Awaiting AOS. \n" % sat
+            if not quiet:
+                print "%s currently below horizon. Awaiting AOS. \n" % sat
             IN_RANGE = False
         else:
-            print "%s AOS Success. Tracking commencing. \n" % sat
+            if not quiet:
+                print "%s AOS Success. Tracking commencing. \n" % sat
             IN_RANGE = True
         return IN_RANGE
 
 #Use to check pos or pass time of sats in list
-def satellite_pos_generator(sat):
-    temp_pos = n.position(sat)
-    temp_pos = str(temp_pos).strip('()')
-    pos_list.append(temp_pos)
-    vel_list.append(n.velocity(sat))
-
-#Checks pos of all sats in list and selects sat if in range
-def satellite_switcher(position, sat):
-    check = position.split(',')
-    check_az = float(check[0])
-    check_el = float(check[1])
-    check_pass = get_countdown_secs(sat)
+def satellite_pos_generator(sat, table=None, positions=None, velocities=None):
+    if positions is None:
+        positions = pos_list
+    if velocities is None:
+        velocities = vel_list
+    if table is not None and sat in table.names:
+        i = table.names.index(sat)
+        temp_pos = str((table.az[i], table.el[i])).strip('()')
+        positions.append(temp_pos)
+        velocities.append(table.range_rate[i])
+        return
+    state = n.state(sat)
+    temp_pos = str((state.az, state.el)).strip('()')
+    positions.append(temp_pos)
+    velocities.append(state.range_rate)
+
+#Picks target from a Predictor.snapshot_all table. Highest sat above horizon
+#wins, otherwise the one with the soonest AOS within 10 mins
+def satellite_switcher(table):
     global SATELLITE_SELECTED
     global SATELLITE
-    print check_el
-    if check_el > 0 or 0 <= check_pass <= 600:
-        SATELLITE = sat
+    best = None
+    for i in range(0, len(table.names)):
+        sat = table.names[i]
+        if sat not in satellite_list:
+            continue
+        check_el  = table.el[i]
+        check_aos = table.aos[i]
+        if check_el > 0:
+            rank = (0, -check_el)
+        elif check_aos is not None and 0 <= check_aos <= 600:
+            rank = (1, check_aos)
+        else:
+            continue
+        if best is None or rank < best[0]:
+            best = (rank, sat)
+    if best is not None:
+        SATELLITE = best[1]
         SATELLITE_SELECTED = True
     elif SATELLITE_SELECTED is not True:
         SATELLITE_SELECTED = None
 
+#Plans PLAN_DAYS of passes for all sats in list, resolving overlaps. With
+#extra antennas, simultaneous passes are spread over them
+def update_plan():
+    global plan
+    plan = None
+    if load_scheduler() is not None:
+        plans = scheduler.Scheduler(n, PRIORITIES).planAntennas(
+            1 + len(antennas), days=PLAN_DAYS)
+        plan = plans[0]
+        for antenna, antenna_plan in zip(antennas, plans[1:]):
+            antenna.plan = antenna_plan
+
+#Selects sat from the tracking plan. No prediction work unless plan runs out
+def follow_plan():
+    global SATELLITE_SELECTED
+    global SATELLITE
+    if plan is None or clock.now() > plan.end - PLAN_REFRESH:
+        update_plan()
+    entry = plan.target()
+    if entry is not None and entry.sat in satellite_list:
+        SATELLITE = entry.sat
+        SATELLITE_SELECTED = True
+    elif antennas:
+        #satellite may be another antenna's, stay free like they do
+        SATELLITE = None
+
 def start_tracker(sat):
     global pos
     global vel
     global passinfo
     global rotorcmd
-    n.loadTLE(sat)
-    pos = n.position(sat)
-    pos = str(pos).strip('()')
-    vel = n.velocity(sat)
-    passinfo = n.nextpass(sat)
+    global traj
+    global path
+    now = clock.now()
+    #published for the rotor threads, which only ever call path.at()
+    new_traj = n.trajectory(sat, now)
+    if new_traj is None:
+        path = None
+    elif new_traj is not traj or path is None:
+        #plan the whole pass once, starting from where the array points
+        path = planPass(new_traj, axis_position(az_axis, el_axis))
+    traj = new_traj
+    if traj is not None and traj.covers(now):
+        #in pass: interpolate the precomputed table instead of computing
+        traj_az, traj_el, vel = traj.at(now)
+        pos = str((traj_az, traj_el)).strip('()')
+    else:
+        state = n.state(sat, now)
+        pos = str((state.az, state.el)).strip('()')
+        vel = state.range_rate
+    passinfo = n.nextpass(sat, now)
     rotorcmd = selection + ' , ' + pos
     return rotorcmd
 
+#Publishes what the predict task just worked out for the control socket.
+#Queries read the last snapshot and never wait on prediction
+def publish_state():
+    global tracker_state
+    sats = []
+    for i in range(0, len(satellite_list)):
+        sat_az, sat_el = pos_list[i].split(',')
+        sats.append({"name": satellite_list[i],
+                     "frequency": frequency_list[i],
+                     "priority": PRIORITIES.get(satellite_list[i], 0),
+                     "az": float(sat_az), "el": float(sat_el),
+                     "range_rate": float(vel_list[i])})
+    state = {"time": clock.now(),
+             "engaged": selection == 'P',
+             "target": SATELLITE,
+             "selected": SATELLITE_SELECTED is True,
+             "in_range": IN_RANGE,
+             "satellites": sats,
+             "antennas": [antenna.state() for antenna in antennas]}
+    if SATELLITE is not None:
+        target_az, target_el = pos.split(',')
+        state.update({"az": float(target_az), "el": float(target_el),
+                      "range_rate": float(vel),
+                      "frequency": FREQUENCY,
+                      "downlink": doppler.downlink,
+                      "uplink": doppler.uplink,
+                      "rotor_mode": path.mode if path else None,
+                      "aos": _utc(passinfo[0]),
+                      "los": _utc(passinfo[4])})
+    tracker_state = state
+
+def _utc(date):
+    return None if date is None else "%s (UTC)" % date
+
+###############################################################################
+#Commands served on the control socket in daemon mode. Each gets the
+#request's arguments and returns the fields to add to the reply
+def _arg(args, name, default=None):
+    if name in args:
+        return args[name]
+    if default is None:
+        raise ControlError("missing argument %r" % name)
+    return default
+
+#The satellite argument as a str, JSON may have made it a number or unicode
+def _satellite(args, default=None):
+    return str(_arg(args, "satellite", default))
+
+def control_state(args):
+    return {"state": tracker_state}
+
+def control_add(args):
+    sat = _satellite(args)
+    try:
+        added = add_satellite(sat, args.get("frequency"))
+    except ValueError as e:
+        raise ControlError(str(e))
+    if not added:
+        raise ControlError("no TLE found for %s" % sat)
+    return {"satellite": added, "satellites": list(satellite_list)}
+
+def control_remove(args):
+    sat = _satellite(args)
+    if not remove_satellite(sat):
+        raise ControlError("not tracking %s" % sat)
+    return {"satellites": list(satellite_list)}
+
+def control_frequency(args):
+    freq = int(_arg(args, "frequency"))
+    with state_lock:
+        sat = _satellite(args, SATELLITE)
+        if sat not in satellite_list:
+            raise ControlError("not tracking %s" % sat)
+        frequency_list[satellite_list.index(sat)] = freq
+    return {"satellite": sat, "frequency": freq}
+
+def control_priority(args):
+    priority = int(_arg(args, "priority"))
+    with state_lock:
+        sat = resolve_satellite(_satellite(args))
+        if sat is None:
+            raise ControlError("no TLE found for %s" % _satellite(args))
+        PRIORITIES[sat] = priority
+        update_plan()
+    return {"satellite": sat, "priority": priority}
+
+def control_engage(args):
+    global selection
+    selection = 'P'
+    return {"engaged": True}
+
+def control_disengage(args):
+    global selection
+    selection = 'p'
+    return {"engaged": False}
+
+def control_park(args):
+    global selection
+    #stop the rotor tasks first so they do not undo the park
+    selection = 'p'
+    return {"engaged": False, "parked": set_parking()}
+
+def control_position(args):
+    pair, connected = rotors, rotors_connected
+    if "antenna" in args:
+        for antenna in antennas:
+            if antenna.name == args["antenna"]:
+                pair, connected = antenna.rotors, antenna.connected
+                break
+        else:
+            raise ControlError("no antenna %s" % args["antenna"])
+    if not connected.wait(ROTOR_WAIT):
+        raise ControlError("rotors not connected yet")
+    az_pos, el_pos = pair.position()
+    return {"az": az_pos, "el": el_pos}
+
+def control_shutdown(args):
+    reply = {}
+    if args.get("park"):
+        reply = control_park(args)
+    engine.stop()
+    return reply
+
+CONTROL_COMMANDS = {
+    "state":     control_state,
+    "add":       control_add,
+    "remove":    control_remove,
+    "frequency": control_frequency,
+    "priority":  control_priority,
+    "engage":    control_engage,
+    "disengage": control_disengage,
+    "park":      control_park,
+    "position":  control_position,
+    "shutdown":  control_shutdown,
+}
+
 def doppler_shift(freq):
     range_rate = vel
     return (range_rate/LIGHT_SPEED) * freq
@@ -475,8 +1201,58 @@ def doppler_shift(freq):
 
 
 ###############################################################################
+def parse_args():
+    parser = argparse.ArgumentParser(description="Nostradamus satellite tracker")
+    parser.add_argument("--daemon", action="store_true",
+                        help="run headless, controlled over the control socket")
+    parser.add_argument("--satellite", action="append", default=[],
+                        metavar="NAME[=HZ]",
+                        help="satellite to track in daemon mode, repeatable")
+    parser.add_argument("--priority", action="append", default=[],
+                        metavar="NAME=N",
+                        help="plan priority of a satellite, higher wins "
+                             "overlapping passes, repeatable")
+    parser.add_argument("--engage", action="store_true",
+                        help="start tracking immediately in daemon mode")
+    parser.add_argument("--socket", default=CONTROL_SOCKET,
+                        help="control socket path (default %(default)s)")
+    parser.add_argument("--status-period", type=float, default=STATUS_PERIOD,
+                        metavar="SECONDS",
+                        help="seconds between status printouts, 0 for none "
+                             "(default %(default)s)")
+    parser.add_argument("--telemetry-dir", default=telemetry.TELEMETRY_DIR,
+                        help="directory for the telemetry log, empty for none "
+                             "(default %(default)s)")
+    parser.add_argument("--antenna", action="append", default=[],
+                        metavar="NAME:AZPORT:ELPORT:GQRXPORT[:UPLINKPORT]",
+                        help="extra antenna set, repeatable")
+    args = parser.parse_args()
+    antenna_sets = list(ANTENNAS)
+    for spec in args.antenna:
+        fields = spec.split(':')
+        if len(fields) not in (4, 5):
+            parser.error("bad --antenna %s" % spec)
+        ports = [int(p) for p in fields[1:]]
+        if len(ports) == 3:
+            ports.append(None)
+        antenna_sets.append(tuple([fields[0]] + ports))
+    satellites = []
+    for spec in args.satellite:
+        sat, sep, freq = spec.partition('=')
+        satellites.append((sat, int(freq) if sep else None))
+    priorities = {}
+    for spec in args.priority:
+        sat, sep, priority = spec.rpartition('=')
+        if not sep:
+            parser.error("bad --priority %s" % spec)
+        priorities[sat] = int(priority)
+    return dict(daemon=args.daemon, satellites=satellites, engage=args.engage,
+                control_socket=args.socket, status_period=args.status_period,
+                telemetry_dir=args.telemetry_dir, antenna_sets=antenna_sets,
+                priorities=priorities)
+
 if __name__ == "__main__":
     try:
-        main()
+        main(**parse_args())
     except KeyboardInterrupt:
         print "\nExiting.\n"
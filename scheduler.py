@@ -0,0 +1,328 @@
+# scheduler.py: multi-day, multi-satellite pass planning on top of Nostradamus
+# Written for UCLA's ELFIN mission <elfin.igpp.ucla.edu>
+
+import bisect
+import collections
+import clock
+import nostradamus
+
+if nostradamus.numpy is None:
+    raise ImportError("scheduler requires numpy and sgp4")
+import numpy
+
+COARSE_STEP  = 30   # seconds between grid samples, shorter passes are missed
+FINE_STEP    = 1    # seconds between refinement samples
+MIN_DURATION = 60   # seconds, shorter leftovers of a conflict are dropped
+PRE_AOS_LEAD = 600  # seconds before AOS a planned pass becomes the target
+
+# Times are unix timestamps, angles in degrees
+Pass = collections.namedtuple("Pass",
+    ["sat", "aos", "los", "max_el", "max_el_time", "aos_az", "los_az"])
+
+# One slot of the tracking plan. start/end may be trimmed to less than the
+# full pass when a higher ranked pass overlaps it.
+PlanEntry = collections.namedtuple("PlanEntry", ["sat", "start", "end", "info"])
+
+################################################################################
+def findPasses(predictor, satName, start, end, step=COARSE_STEP, min_el=0.0,
+               station=None):
+    '''Returns every pass of satName over station (the predictor's default
+       if None) between start and end, sorted by AOS. el is sampled on a
+       coarse grid with Predictor.track, then horizon crossings and
+       culminations are refined on a FINE_STEP grid in one more batched
+       call. Passes in progress at start or end are clipped.
+    '''
+    if station is None:
+        station = predictor.getStation()
+    return findNetworkPasses(predictor, satName, start, end, step, min_el,
+                             [station])[station]
+
+def findNetworkPasses(predictor, satName, start, end, step=COARSE_STEP,
+                      min_el=0.0, stations=None):
+    '''findPasses for every ground station (or the given station names).
+       The satellite is propagated once for the coarse grid and once for
+       all refinement windows, whatever the number of stations. Returns a
+       dict of station name -> passes.
+    '''
+    if stations is None:
+        stations = predictor.getStations()
+    times = _grid(start, end, step)
+    coarse = predictor.trackNetwork(satName, times, stations)
+
+    # gather every refinement window so they all go through one propagation
+    chunks = []
+    spans  = {}
+    pos = 0
+    for st in stations:
+        windows = _windows(times, coarse[st].el - min_el, step, start, end)
+        spans[st], pos = _fineGrid(windows, chunks, pos)
+    if not chunks:
+        return dict((st, []) for st in stations)
+    fine_t = numpy.concatenate(chunks)
+    fine = predictor.trackNetwork(satName, fine_t,
+                                  [st for st in stations if spans[st]])
+
+    passes = {}
+    for st in stations:
+        passes[st] = _refine(satName, spans[st], fine_t, fine.get(st),
+                             coarse[st], start, end, min_el)
+    return passes
+
+def findCatalogPasses(predictor, entries, start, end, step=COARSE_STEP,
+                      min_el=0.0, station=None):
+    '''findPasses for raw (name, line 1, line 2) TLE entries that were never
+       added as satellites, e.g. a whole catalog from TLECatalog.getEntries.
+       The coarse grid of all entries is one batched propagation. Returns
+       their passes sorted by AOS.
+    '''
+    times = _grid(start, end, step)
+    coarse = predictor.trackTLEs(entries, times, station)
+    passes = []
+    for i, entry in enumerate(entries):
+        row = nostradamus.Track(*[field[i] for field in coarse])
+        chunks = []
+        spans, pos = _fineGrid(_windows(times, row.el - min_el, step, start,
+                                        end), chunks, 0)
+        if not chunks:
+            continue
+        fine_t = numpy.concatenate(chunks)
+        fine = predictor.trackTLEs([entry], fine_t, station)
+        fine = nostradamus.Track(*[field[0] for field in fine])
+        passes.extend(_refine(entry[0].strip(), spans, fine_t, fine, row,
+                              start, end, min_el))
+    passes.sort(key=lambda p: p.aos)
+    return passes
+
+def _grid(start, end, step):
+    times = numpy.arange(start, end + step, step, dtype=float)
+    times[-1] = min(times[-1], end)
+    return times
+
+def _fineGrid(windows, chunks, pos):
+    '''Appends FINE_STEP sample times for every window to chunks. Returns
+       the (rise, set, peak) slices of each window into the concatenated
+       chunks, and the position after them.
+    '''
+    spans = []
+    for window in windows:
+        slices = []
+        for w in window:
+            if w is None:
+                slices.append(None)
+                continue
+            chunk = numpy.arange(w[0], w[1] + FINE_STEP, FINE_STEP)
+            chunks.append(chunk)
+            slices.append(slice(pos, pos + len(chunk)))
+            pos += len(chunk)
+        spans.append(slices)
+    return spans, pos
+
+def _refine(satName, spans, fine_t, f, coarse, start, end, min_el):
+    '''Builds a Pass per refined window'''
+    passes = []
+    if not spans:
+        return passes
+    fine_el = f.el - min_el
+    for rise, fall, peak in spans:
+        if rise is None:
+            aos, aos_az = start, coarse.az[0]
+        else:
+            aos, aos_az = _crossing(fine_t[rise], fine_el[rise],
+                                    f.az[rise], rising=True)
+        if fall is None:
+            los, los_az = end, coarse.az[-1]
+        else:
+            los, los_az = _crossing(fine_t[fall], fine_el[fall],
+                                    f.az[fall], rising=False)
+        k = peak.start + int(numpy.nanargmax(f.el[peak]))
+        passes.append(Pass(satName, aos, los, float(f.el[k]),
+                           float(fine_t[k]), float(aos_az), float(los_az)))
+    return passes
+
+def _windows(times, el, step, start, end):
+    '''Finds passes on the coarse grid. Returns (rise, set, peak) time
+       windows per pass to refine; rise/set are None for clipped passes.
+    '''
+    up = numpy.nan_to_num(el) > 0
+    if not up.any():
+        return []
+    edges = numpy.diff(up.astype(int))
+    rises = list(numpy.nonzero(edges == 1)[0])
+    sets  = list(numpy.nonzero(edges == -1)[0])
+    if up[0]:
+        rises.insert(0, None)
+    if up[-1]:
+        sets.append(None)
+    windows = []
+    for r, s in zip(rises, sets):
+        first = 0 if r is None else r + 1
+        last  = len(times) - 1 if s is None else s
+        peak  = first + int(numpy.argmax(el[first:last + 1]))
+        windows.append((
+            None if r is None else (times[r], times[r + 1]),
+            None if s is None else (times[s], times[s + 1]),
+            (max(times[peak] - step, start), min(times[peak] + step, end)),
+        ))
+    return windows
+
+def _crossing(t, el, az, rising):
+    '''Linearly interpolates the horizon crossing inside one fine window'''
+    above = numpy.nan_to_num(el) > 0
+    if rising:
+        j = int(numpy.argmax(above)) - 1
+    else:
+        j = len(above) - 1 - int(numpy.argmax(above[::-1]))
+    if j < 0 or j >= len(above) - 1:
+        j = min(max(j, 0), len(above) - 1)
+        return float(t[j]), float(az[j])
+    e0, e1 = el[j], el[j + 1]
+    frac = -e0 / (e1 - e0) if e1 != e0 else 0.0
+    return (float(t[j] + frac * (t[j + 1] - t[j])),
+            float(az[j + 1] if rising else az[j]))
+
+################################################################################
+class Plan(object):
+    '''Ordered, non-overlapping tracking plan for one antenna, produced by
+       Scheduler.plan or planAntennas
+    '''
+    def __init__(self, entries, start, end):
+        self.entries = sorted(entries, key=lambda e: e.start)
+        self.start   = start
+        self.end     = end
+        self._starts = [e.start for e in self.entries]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def current(self, date=None):
+        '''Returns the entry being tracked at date or None'''
+        if date is None:
+            date = clock.now()
+        i = bisect.bisect_right(self._starts, date) - 1
+        if i >= 0 and date < self.entries[i].end:
+            return self.entries[i]
+        return None
+
+    def upcoming(self, date=None):
+        '''Returns the first entry starting after date or None'''
+        if date is None:
+            date = clock.now()
+        i = bisect.bisect_right(self._starts, date)
+        if i < len(self.entries):
+            return self.entries[i]
+        return None
+
+    def target(self, date=None, lead=PRE_AOS_LEAD):
+        '''Returns the current entry, or the upcoming one if it starts within
+           lead seconds, or None when the antenna is free
+        '''
+        if date is None:
+            date = clock.now()
+        entry = self.current(date)
+        if entry is None:
+            entry = self.upcoming(date)
+            if entry is not None and entry.start - date > lead:
+                entry = None
+        return entry
+
+################################################################################
+class Scheduler(object):
+    def __init__(self, predictor, priorities=None, min_el=0.0,
+                 step=COARSE_STEP, min_duration=MIN_DURATION):
+        ''' @param priorities
+                dict of satellite name -> priority, higher wins a conflict.
+                Satellites not listed get priority 0. Ties go to the pass
+                with the higher maximum elevation.
+        '''
+        self.predictor    = predictor
+        self.priorities   = dict(priorities or {})
+        self.min_el       = min_el
+        self.step         = step
+        self.min_duration = min_duration
+
+    def setPriority(self, satName, priority):
+        self.priorities[satName] = priority
+
+    def passes(self, start, end, station=None):
+        '''Returns every pass of every satellite added to the predictor'''
+        if station is None:
+            station = self.predictor.getStation()
+        return self.networkPasses(start, end, [station])[station]
+
+    def networkPasses(self, start, end, stations=None):
+        '''Returns a dict of station name -> passes of every satellite over
+           that station, sharing each satellite's propagation across the
+           whole ground network
+        '''
+        if stations is None:
+            stations = self.predictor.getStations()
+        passes = dict((st, []) for st in stations)
+        seen   = set()
+        for name in self.predictor.getSatellites():
+            if name in seen:
+                continue
+            seen.add(name)
+            found = findNetworkPasses(self.predictor, name, start, end,
+                                      self.step, self.min_el, stations)
+            for st in stations:
+                passes[st].extend(found[st])
+        for st in stations:
+            passes[st].sort(key=lambda p: p.aos)
+        return passes
+
+    def plan(self, start=None, days=1):
+        '''Plans the next days of tracking. Passes are booked best first by
+           (priority, max elevation); a pass that overlaps booked time keeps
+           its longest free stretch if that is at least min_duration long.
+        '''
+        return self.planAntennas(1, start, days)[0]
+
+    def planAntennas(self, antennas, start=None, days=1):
+        '''Plans the next days of tracking for several antennas at the
+           station. Passes are booked best first as in plan(), each on the
+           antenna where it keeps the longest free stretch, so simultaneous
+           passes spread over free antennas. Ties go to the lower numbered
+           antenna. Returns a list of antennas Plans.
+        '''
+        if start is None:
+            start = clock.now()
+        end = start + days * 86400
+        ranked = sorted(self.passes(start, end),
+                        key=lambda p: (-self.priorities.get(p.sat, 0),
+                                       -p.max_el))
+        booked  = [[] for i in range(antennas)]
+        entries = [[] for i in range(antennas)]
+        for p in ranked:
+            best = None
+            for i in range(antennas):
+                free = _subtract((p.aos, p.los), booked[i])
+                if not free:
+                    continue
+                seg = max(free, key=lambda f: f[1] - f[0])
+                if best is None or seg[1] - seg[0] > best[1][1] - best[1][0]:
+                    best = (i, seg)
+            if best is None or best[1][1] - best[1][0] < self.min_duration:
+                continue
+            i, seg = best
+            booked[i].append(seg)
+            entries[i].append(PlanEntry(p.sat, seg[0], seg[1], p))
+        return [Plan(e, start, end) for e in entries]
+
+def _subtract(interval, booked):
+    '''Returns the parts of interval not covered by any booked interval'''
+    free = [interval]
+    for b0, b1 in booked:
+        remaining = []
+        for f0, f1 in free:
+            if b1 <= f0 or b0 >= f1:
+                remaining.append((f0, f1))
+                continue
+            if f0 < b0:
+                remaining.append((f0, b0))
+            if b1 < f1:
+                remaining.append((b1, f1))
+        free = remaining
+    return free
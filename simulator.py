@@ -0,0 +1,548 @@
+#!/usr/bin/python
+
+# simulator.py: stand-in rotctld and GQRX servers for soak-testing the tracker
+# Written for UCLA's ELFIN mission <elfin.igpp.ucla.edu>
+
+# Serves the two RT-21 rotctld ports and the GQRX remote control port on
+# localhost so satellite_tracker.py runs without hardware:
+#
+#   ./simulator.py --fault-rate 0.01 --satellite "CUBESAT 221"
+#   ./satellite_tracker.py            (in another terminal)
+#
+# Each axis slews towards its last accepted target at a fixed rate and
+# rejects targets outside its limits like rotctld does. Replies are delayed
+# by the serial latency, and a fraction of requests can be answered with an
+# error, stalled, silently ignored or dropped. With --satellite, where the
+# array actually points is compared against the predicted pass and the
+# pointing error is reported on exit.
+#
+# With --track the tracker runs in the same process, and --rate puts both
+# on simulated time, e.g. a day of passes at 1000x, or as fast as the
+# tracker computes with --rate 0:
+#
+#   ./simulator.py --track "CUBESAT 221=437000000" --rate 0 --duration 86400
+#
+# --antennas simulates more antenna sets for the tracker, each on ports
+# ANTENNA_PORT_STEP above the one before.
+
+import argparse
+import array
+import random
+import socket
+import sys
+import threading
+import time
+from math import *
+
+import clock
+import nostradamus
+
+AZ_PORT   = 4535
+EL_PORT   = 4537
+GQRX_PORT = 7356
+ANTENNA_PORT_STEP = 100 # port offset between simulated antenna sets
+
+SLEW_RATE = 5.0   # degrees per second per axis
+LATENCY   = 0.05  # seconds, serial round trip to the controller
+JITTER    = 0.02  # seconds, uniform extra latency
+STALL     = 5.0   # seconds a stalled request hangs (rotctld timeout=5000)
+FAULTS    = ("error", "stall", "ignore", "drop")
+SAMPLE_PERIOD = 0.1 # seconds between pointing error samples
+LOCK_ERROR    = 1.0 # degrees, pointing error counts once first inside this
+
+# limits as set up in start_rotor.sh, both axes are az rotors
+AZ_LIMITS = (-5.0, 360.0)
+EL_LIMITS = (-5.0, 185.0)
+
+################################################################################
+class Faults(object):
+    '''Decides which requests misbehave. rate is the chance per request;
+       the kind is drawn uniformly from kinds.
+    '''
+    def __init__(self, rate=0.0, kinds=FAULTS, seed=None):
+        self.rate   = rate
+        self.kinds  = tuple(kinds)
+        self.random = random.Random(seed)
+        self.counts = dict((k, 0) for k in self.kinds)
+        self._lock  = threading.Lock()
+
+    def draw(self):
+        '''Returns a fault kind for the next request, or None'''
+        with self._lock:
+            if not self.rate or self.random.random() >= self.rate:
+                return None
+            kind = self.random.choice(self.kinds)
+            self.counts[kind] += 1
+            return kind
+
+################################################################################
+class SimAxis(object):
+    '''One rotor axis. Moves towards target at slew_rate degrees per second;
+       the position is advanced lazily whenever it is read or commanded.
+    '''
+    def __init__(self, name, limits, slew_rate=SLEW_RATE, position=0.0):
+        self.name      = name
+        self.min       = limits[0]
+        self.max       = limits[1]
+        self.slew_rate = slew_rate
+        self.position  = position
+        self.target    = position
+        self.commands  = 0
+        self.rejected  = 0
+        self._time     = clock.now()
+        self._lock     = threading.Lock()
+
+    def _advance(self, now):
+        step = self.slew_rate * max(now - self._time, 0)
+        delta = self.target - self.position
+        if abs(delta) <= step:
+            self.position = self.target
+        else:
+            self.position += step if delta > 0 else -step
+        self._time = now
+
+    def read(self, now=None):
+        with self._lock:
+            self._advance(clock.now() if now is None else now)
+            return self.position
+
+    def command(self, value, now=None):
+        '''Sets a new target. Returns False if it is outside the limits'''
+        with self._lock:
+            self._advance(clock.now() if now is None else now)
+            if not self.min <= value <= self.max:
+                self.rejected += 1
+                return False
+            self.target = value
+            self.commands += 1
+            return True
+
+    def stop(self, now=None):
+        with self._lock:
+            self._advance(clock.now() if now is None else now)
+            self.target = self.position
+
+################################################################################
+class LineServer(object):
+    '''Line-based TCP server in the style of rotctld and GQRX: one thread
+       per client, one reply per request line. Subclasses implement reply().
+    '''
+    def __init__(self, port, host="127.0.0.1", latency=LATENCY, jitter=JITTER,
+                 faults=None, stall=STALL):
+        self.latency  = latency
+        self.jitter   = jitter
+        self.faults   = faults or Faults()
+        self.stall    = stall
+        self.requests = 0
+        self.clients  = 0
+        self.random   = random.Random()
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        self._stopped = threading.Event()
+
+    def start(self):
+        thread = threading.Thread(target=self._accept,
+                                  name="%s:%d" % (type(self).__name__, self.port))
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self.sock.close()
+
+    def _accept(self):
+        while not self._stopped.is_set():
+            try:
+                conn, addr = self.sock.accept()
+            except EnvironmentError:
+                return
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.clients += 1
+            thread = threading.Thread(target=self._serve, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, conn):
+        buf = ''
+        try:
+            while not self._stopped.is_set():
+                data = conn.recv(1024)
+                if not data:
+                    return
+                buf += data
+                while '\n' in buf:
+                    line, buf = buf.split('\n', 1)
+                    line = line.strip()
+                    if not line:
+                        continue
+                    if self._stopped.is_set():
+                        return
+                    self.requests += 1
+                    fault = self.faults.draw()
+                    if fault == "drop":
+                        return
+                    if fault == "stall":
+                        clock.wait(self._stopped, self.stall)
+                    delay = self.latency + self.random.uniform(0, self.jitter)
+                    if delay > 0:
+                        clock.wait(self._stopped, delay)
+                    if fault == "error":
+                        reply = self.error()
+                    else:
+                        reply = self.reply(line, fault == "ignore")
+                    if reply is None:
+                        return
+                    conn.sendall(reply)
+        except EnvironmentError:
+            pass
+        finally:
+            conn.close()
+
+    def error(self):
+        return "RPRT -5\n" # RIG_ETIMEOUT, the controller did not answer
+
+    def reply(self, line, ignore):
+        '''Returns the reply to one request line, None to hang up. ignore
+           means the command is acknowledged but has no effect.
+        '''
+        raise NotImplementedError
+
+################################################################################
+class RotctldSim(LineServer):
+    '''rotctld for one RT-21 set up as an az rotor: "P <angle> <el>" moves
+       the axis, "p" reads it back, "S" stops and "K" parks at park.
+    '''
+    def __init__(self, axis, port, park=0.0, **kwargs):
+        LineServer.__init__(self, port, **kwargs)
+        self.axis = axis
+        self.park = park
+
+    def reply(self, line, ignore):
+        args = line.split()
+        cmd  = args[0]
+        if cmd in ('P', '\\set_pos'):
+            try:
+                value = float(args[1])
+            except (IndexError, ValueError):
+                return "RPRT -1\n"
+            if ignore:
+                return "RPRT 0\n"
+            return "RPRT 0\n" if self.axis.command(value) else "RPRT -1\n"
+        if cmd in ('p', '\\get_pos'):
+            return "%f\n%f\n" % (self.axis.read(), 0.0)
+        if cmd in ('S', '\\stop'):
+            if not ignore:
+                self.axis.stop()
+            return "RPRT 0\n"
+        if cmd in ('K', '\\park'):
+            if not ignore:
+                self.axis.command(self.park)
+            return "RPRT 0\n"
+        if cmd in ('_', '\\get_info'):
+            return "Simulated RT-21 %s\n" % self.axis.name
+        if cmd in ('q', 'Q'):
+            return None
+        return "RPRT -4\n" # RIG_ENIMPL
+
+class GqrxSim(LineServer):
+    '''GQRX remote control: frequency, demodulator mode and signal level.
+       Every accepted frequency is kept in history as (time, Hz).
+    '''
+    def __init__(self, port, frequency=437000000, **kwargs):
+        LineServer.__init__(self, port, **kwargs)
+        self.frequency = frequency
+        self.mode      = "FM"
+        self.passband  = 10000
+        self.history   = []
+
+    def error(self):
+        return "RPRT 1\n"
+
+    def reply(self, line, ignore):
+        args = line.split()
+        cmd  = args[0]
+        if cmd == 'F':
+            try:
+                hz = int(float(args[1]))
+            except (IndexError, ValueError):
+                return "RPRT 1\n"
+            if not ignore:
+                self.frequency = hz
+                self.history.append((clock.now(), hz))
+            return "RPRT 0\n"
+        if cmd == 'f':
+            return "%d\n" % self.frequency
+        if cmd == 'M':
+            if len(args) < 2:
+                return "RPRT 1\n"
+            if not ignore:
+                self.mode = args[1]
+                if len(args) > 2:
+                    self.passband = int(args[2])
+            return "RPRT 0\n"
+        if cmd == 'm':
+            return "%s\n%d\n" % (self.mode, self.passband)
+        if cmd == 'l':
+            return "%.1f\n" % self.random.uniform(-80, -40)
+        if cmd in ('L', 'U', 'AOS', 'LOS'):
+            return "RPRT 0\n"
+        if cmd in ('u', 'c'):
+            return "0\n"
+        if cmd == 'q':
+            return None
+        return "RPRT 1\n"
+
+################################################################################
+class PointingMonitor(threading.Thread):
+    '''Samples where the simulated array points against where satName is,
+       while it is above min_el, and keeps the errors for report(). The
+       slew onto each pass is timed as acquisition instead: errors count
+       from the first sample within lock degrees until LOS.
+    '''
+    def __init__(self, predictor, satName, az_axis, el_axis,
+                 period=SAMPLE_PERIOD, min_el=0.0, lock=LOCK_ERROR):
+        threading.Thread.__init__(self, name="pointing")
+        self.daemon    = True
+        self.predictor = predictor
+        self.satName   = satName
+        self.az_axis   = az_axis
+        self.el_axis   = el_axis
+        self.period    = period
+        self.min_el    = min_el
+        self.lock      = lock
+        self.acquiring = None # time the current pass rose, until locked
+        self.locked    = False
+        self.acquisitions = []
+        self.az_err    = array.array('f')
+        self.el_err    = array.array('f')
+        self.total_err = array.array('f')
+        self._stopped  = threading.Event()
+
+    def sample(self, now=None):
+        if now is None:
+            now = clock.now()
+        state = self.predictor.state(self.satName, now)
+        if state is None or state.el < self.min_el:
+            self.acquiring = None
+            self.locked    = False
+            return
+        az = self.az_axis.read(now) % 360
+        el = self.el_axis.read(now)
+        if el > 90:
+            # flipped over the top, compare as the same direction pointed
+            # at normally
+            az, el = (az + 180) % 360, 180 - el
+        total = _separation(az, el, state.az, state.el)
+        if not self.locked:
+            if self.acquiring is None:
+                self.acquiring = now
+            if total > self.lock:
+                return
+            self.locked = True
+            self.acquisitions.append(now - self.acquiring)
+        self.az_err.append(abs((az - state.az + 180) % 360 - 180))
+        self.el_err.append(abs(el - state.el))
+        self.total_err.append(total)
+
+    def run(self):
+        while not self._stopped.is_set():
+            self.sample()
+            clock.wait(self._stopped, self.period)
+
+    def stop(self):
+        self._stopped.set()
+
+    def report(self):
+        '''Returns {axis: (samples, mean, rms, p95, max)} in degrees'''
+        out = {}
+        for name, errs in (("az", self.az_err), ("el", self.el_err),
+                           ("total", self.total_err)):
+            if not errs:
+                out[name] = (0, 0.0, 0.0, 0.0, 0.0)
+                continue
+            s = sorted(errs)
+            n = len(s)
+            out[name] = (n, sum(s) / n, sqrt(sum(e * e for e in s) / n),
+                         s[min(int(0.95 * n), n - 1)], s[-1])
+        return out
+
+def _separation(az1, el1, az2, el2):
+    '''Angle in degrees between two az/el directions'''
+    az1, el1, az2, el2 = map(radians, (az1, el1, az2, el2))
+    c = (sin(el1) * sin(el2) + cos(el1) * cos(el2) * cos(az1 - az2))
+    return degrees(acos(max(-1.0, min(1.0, c))))
+
+################################################################################
+class Simulator(object):
+    '''Both rotor axes and GQRX, started and stopped together'''
+    def __init__(self, host="127.0.0.1", az_port=AZ_PORT, el_port=EL_PORT,
+                 gqrx_port=GQRX_PORT, slew_rate=SLEW_RATE, latency=LATENCY,
+                 jitter=JITTER, faults=None, stall=STALL):
+        faults = faults or Faults()
+        opts = dict(host=host, latency=latency, jitter=jitter, faults=faults,
+                    stall=stall)
+        self.faults  = faults
+        self.az_axis = SimAxis("AZ", AZ_LIMITS, slew_rate)
+        self.el_axis = SimAxis("EL", EL_LIMITS, slew_rate)
+        self.az   = RotctldSim(self.az_axis, az_port, park=130.0, **opts)
+        self.el   = RotctldSim(self.el_axis, el_port, park=90.0, **opts)
+        self.gqrx = GqrxSim(gqrx_port, **opts)
+        self.monitor = None
+
+    def start(self):
+        for server in (self.az, self.el, self.gqrx):
+            server.start()
+        return self
+
+    def watch(self, predictor, satName, **kwargs):
+        '''Starts measuring pointing error against satName'''
+        self.monitor = PointingMonitor(predictor, satName, self.az_axis,
+                                       self.el_axis, **kwargs)
+        self.monitor.start()
+        return self.monitor
+
+    def stop(self):
+        if self.monitor is not None:
+            self.monitor.stop()
+        for server in (self.az, self.el, self.gqrx):
+            server.stop()
+
+    def report(self):
+        lines = []
+        for server, axis in ((self.az, self.az_axis), (self.el, self.el_axis)):
+            lines.append("%s: %d requests, %d moves, %d rejected, at %.2f"
+                         % (axis.name, server.requests, axis.commands,
+                            axis.rejected, axis.read()))
+        lines.append("GQRX: %d requests, %d retunes, at %d Hz"
+                     % (self.gqrx.requests, len(self.gqrx.history),
+                        self.gqrx.frequency))
+        lines.append("Faults: " + ", ".join("%s %d" % kv for kv in
+                                            sorted(self.faults.counts.items())))
+        if self.monitor is not None:
+            acq = self.monitor.acquisitions
+            lines.append("Acquired %s %d times, worst after %.1fs"
+                         % (self.monitor.satName, len(acq), max(acq or [0])))
+            lines.append("Pointing error once acquired (degrees):")
+            lines.append("  %-6s %8s %8s %8s %8s %8s"
+                         % ("", "samples", "mean", "rms", "p95", "max"))
+            for name, (n, mean, rms, p95, worst) in sorted(
+                    self.monitor.report().items()):
+                lines.append("  %-6s %8d %8.3f %8.3f %8.3f %8.3f"
+                             % (name, n, mean, rms, p95, worst))
+        return "\n".join(lines)
+
+################################################################################
+def main():
+    parser = argparse.ArgumentParser(
+        description="Simulated RT-21 rotctld axes and GQRX")
+    parser.add_argument("--slew", type=float, default=SLEW_RATE,
+                        help="degrees per second per axis")
+    parser.add_argument("--latency", type=float, default=LATENCY,
+                        help="seconds added to every reply")
+    parser.add_argument("--jitter", type=float, default=JITTER)
+    parser.add_argument("--fault-rate", type=float, default=0.0,
+                        help="chance per request of a fault")
+    parser.add_argument("--faults", default=",".join(FAULTS),
+                        help="fault kinds to inject, from %s" % ",".join(FAULTS))
+    parser.add_argument("--stall", type=float, default=STALL)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--satellite",
+                        help="measure pointing error against this satellite")
+    parser.add_argument("--duration", type=float,
+                        help="seconds to run, default until Ctrl-C")
+    parser.add_argument("--report-every", type=float, default=0,
+                        help="seconds between interim reports")
+    parser.add_argument("--track", action="append", default=[],
+                        metavar="NAME[=HZ]",
+                        help="run the tracker in this process on this "
+                             "satellite, repeatable")
+    parser.add_argument("--rate", type=float, default=1.0,
+                        help="simulated seconds per second, 0 to step "
+                             "through time as fast as the tracker computes")
+    parser.add_argument("--start", type=float,
+                        help="unix time the simulated clock starts at")
+    parser.add_argument("--antennas", type=int, default=1,
+                        help="antenna sets to simulate for --track")
+    args = parser.parse_args()
+
+    if args.rate == 0:
+        if not args.track:
+            sys.exit("--rate 0 needs --track to step the clock")
+        clock.use(clock.SteppedClock(args.start))
+        # a reply cannot wait for a clock that only moves between ticks
+        args.latency = args.jitter = 0
+    elif args.rate != 1 or args.start is not None:
+        clock.use(clock.ScaledClock(args.start, args.rate))
+
+    faults = Faults(args.fault_rate, args.faults.split(","), args.seed)
+    sim = Simulator(slew_rate=args.slew, latency=args.latency,
+                    jitter=args.jitter, faults=faults, stall=args.stall).start()
+    if args.satellite:
+        n = nostradamus.Predictor()
+        if not n.addSatellite(args.satellite):
+            sys.exit("unknown satellite %s" % args.satellite)
+        sim.watch(n, args.satellite)
+    print("Simulating AZ on %d, EL on %d, GQRX on %d"
+          % (sim.az.port, sim.el.port, sim.gqrx.port))
+    extra = []
+    for i in range(1, args.antennas):
+        step = i * ANTENNA_PORT_STEP
+        extra.append(Simulator(az_port=AZ_PORT + step, el_port=EL_PORT + step,
+                               gqrx_port=GQRX_PORT + step,
+                               slew_rate=args.slew, latency=args.latency,
+                               jitter=args.jitter, faults=faults,
+                               stall=args.stall).start())
+        print("Antenna %d: AZ on %d, EL on %d, GQRX on %d"
+              % (i + 1, AZ_PORT + step, EL_PORT + step, GQRX_PORT + step))
+    antenna_sets = [("ANT%d" % (i + 2), s.az.port, s.el.port, s.gqrx.port,
+                     None) for i, s in enumerate(extra)]
+    tracker = None
+    if args.track:
+        import satellite_tracker
+        tracker = satellite_tracker
+        satellites = []
+        for spec in args.track:
+            sat, sep, freq = spec.partition("=")
+            satellites.append((sat, int(freq) if sep else None))
+        thread = threading.Thread(target=tracker.main, name="tracker",
+                                  kwargs=dict(daemon=True, engage=True,
+                                              satellites=satellites,
+                                              status_period=None,
+                                              antenna_sets=antenna_sets))
+        thread.daemon = True
+        thread.start()
+
+    began = time.time()
+    start = last = clock.now()
+    try:
+        while args.duration is None or clock.now() - start < args.duration:
+            clock.sleep(0.5)
+            if args.report_every and clock.now() - last >= args.report_every:
+                last = clock.now()
+                print(sim.report())
+    except KeyboardInterrupt:
+        pass
+    engine = getattr(tracker, "engine", None)
+    if engine is not None:
+        engine.stop()
+        thread.join(5)
+    sim.stop()
+    print(sim.report())
+    for i, s in enumerate(extra):
+        s.stop()
+        print("Antenna %d:" % (i + 2))
+        print(s.report())
+    wall = time.time() - began
+    print("%.0f simulated seconds in %.1f s, %.0fx"
+          % (clock.now() - start, wall, (clock.now() - start) / wall))
+    if engine is not None:
+        print("Tracker compute per tick:")
+        for name, (runs, mean) in sorted(engine.budget().items()):
+            print("  %-14s %8d runs %9.3f ms" % (name, runs, 1000 * mean))
+
+if __name__ == "__main__":
+    main()
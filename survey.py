@@ -0,0 +1,133 @@
+#!/usr/bin/python
+
+# survey.py: visibility survey of a whole TLE catalog over one station
+# Written for UCLA's ELFIN mission <elfin.igpp.ucla.edu>
+
+# Finds every pass of every object in tle.txt in a time window and prints
+# them sorted by AOS (or max elevation, or name). The catalog is split
+# into chunks that run on a process pool, one worker per core by default:
+#
+#   ./survey.py --hours 24 --min-el 10
+#   ./survey.py --sort max_el --csv > passes.csv
+
+import argparse
+import datetime
+import multiprocessing
+import sys
+import time
+import nostradamus
+import scheduler
+
+SURVEY_HOURS = 24
+SURVEY_CHUNK = 64 # satellites per pool task
+
+_predictor = None # per worker process, see _init
+
+################################################################################
+def _init(station, location):
+    global _predictor
+    if station is None:
+        _predictor = nostradamus.Predictor()
+    else:
+        _predictor = nostradamus.Predictor(knudsen=False)
+        _predictor.setStation(station, location)
+
+def _survey(task):
+    entries, start, end, step, min_el = task
+    return scheduler.findCatalogPasses(_predictor, entries, start, end, step,
+                                       min_el)
+
+def survey(entries, start, end, step=scheduler.COARSE_STEP, min_el=0.0,
+           processes=None, station=None, location=None, chunk=SURVEY_CHUNK):
+    '''Returns every pass of the given (name, line 1, line 2) TLE entries
+       between start and end, sorted by AOS. Runs chunk satellites per task
+       on a pool of processes (one per core if None, in this process if
+       1). station/location set up a station other than Knudsen.
+    '''
+    tasks = [(entries[i:i + chunk], start, end, step, min_el)
+             for i in range(0, len(entries), chunk)]
+    if processes == 1:
+        _init(station, location)
+        results = map(_survey, tasks)
+    else:
+        pool = multiprocessing.Pool(processes, _init, (station, location))
+        try:
+            # imap keeps memory flat, results are merged as they arrive
+            results = list(pool.imap_unordered(_survey, tasks))
+        finally:
+            pool.terminate()
+    passes = [p for result in results for p in result]
+    passes.sort(key=lambda p: p.aos)
+    return passes
+
+################################################################################
+def _utc(t):
+    return datetime.datetime.utcfromtimestamp(t).strftime("%Y/%m/%d %H:%M:%S")
+
+SORT_KEYS = {
+    "aos":    lambda p: p.aos,
+    "max_el": lambda p: (-p.max_el, p.aos),
+    "sat":    lambda p: (p.sat, p.aos),
+}
+
+def report(passes, out=sys.stdout, csv=False):
+    if csv:
+        out.write("satellite,aos,los,duration_s,max_el,max_el_time,aos_az,"
+                  "los_az\n")
+        for p in passes:
+            out.write('"%s",%s,%s,%.0f,%.2f,%s,%.1f,%.1f\n'
+                      % (p.sat, _utc(p.aos), _utc(p.los), p.los - p.aos,
+                         p.max_el, _utc(p.max_el_time), p.aos_az, p.los_az))
+        return
+    out.write("%-24s %-19s %-19s %8s %6s %6s %6s\n"
+              % ("SATELLITE", "AOS (UTC)", "LOS (UTC)", "DURATION", "MAX EL",
+                 "AOS AZ", "LOS AZ"))
+    for p in passes:
+        out.write("%-24s %-19s %-19s %8s %6.1f %6.1f %6.1f\n"
+                  % (p.sat, _utc(p.aos), _utc(p.los),
+                     str(datetime.timedelta(seconds=int(p.los - p.aos))),
+                     p.max_el, p.aos_az, p.los_az))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Survey every pass of a TLE catalog over the station")
+    parser.add_argument("--tle", default="tle.txt")
+    parser.add_argument("--hours", type=float, default=SURVEY_HOURS)
+    parser.add_argument("--start", type=float,
+                        help="unix time to start at, default now")
+    parser.add_argument("--min-el", type=float, default=0.0)
+    parser.add_argument("--step", type=float, default=scheduler.COARSE_STEP,
+                        help="coarse grid in seconds, shorter passes are missed")
+    parser.add_argument("--processes", type=int,
+                        help="worker processes, default one per core")
+    parser.add_argument("--station", help="station name, default Knudsen")
+    parser.add_argument("--location", nargs=3, metavar=("LAT", "LON", "ALT"),
+                        help="station latitude, longitude (degrees) and "
+                             "elevation (m)")
+    parser.add_argument("--sort", choices=sorted(SORT_KEYS), default="aos")
+    parser.add_argument("--csv", action="store_true")
+    args = parser.parse_args()
+
+    location = None
+    if args.location:
+        location = (args.location[0], args.location[1],
+                    float(args.location[2]))
+        if args.station is None:
+            args.station = "STATION"
+    elif args.station is not None:
+        sys.exit("--station needs --location")
+
+    start = args.start if args.start is not None else time.time()
+    end = start + args.hours * 3600
+    entries = nostradamus.TLECatalog(args.tle).getEntries()
+    began = time.time()
+    passes = survey(entries, start, end, args.step, args.min_el,
+                    args.processes, args.station, location)
+    passes.sort(key=SORT_KEYS[args.sort])
+    report(passes, csv=args.csv)
+    sys.stderr.write("%d passes of %d objects over %.1f h in %.1f s\n"
+                     % (len(passes), len(entries), args.hours,
+                        time.time() - began))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+#!/usr/bin/python
+
+# telemetry.py: binary tracking telemetry log and its replay tool
+# Written for UCLA's ELFIN mission <elfin.igpp.ucla.edu>
+
+# The tracker appends one fixed-size record per telemetry tick to a file
+# per UTC day, telemetry/telemetry-YYYYMMDD.bin. Days older than keep are
+# deleted as the log rotates. A whole day maps straight into a NumPy record
+# array, nothing is parsed:
+#
+#   ./telemetry.py                        # pass summaries for today
+#   ./telemetry.py --day 20261018 --sat "FIREBIRD 4"
+#   ./telemetry.py telemetry/telemetry-20261018.bin --csv > day.csv
+#
+# Layout, little endian: a HEADER_SIZE byte header (see HEADER), then
+# RECORD_SIZE byte records (see RECORD). Angles are in degrees, NaN where
+# unknown; range rate in km/s; frequency in Hz, 0 if none was tuned. The
+# rotor codes are the last RPRT code of each axis, CODE_NONE before the
+# first command and CODE_TIMEOUT if it got no reply. antenna is the index
+# of the antenna set the record is for, 0 for the main one.
+
+import argparse
+import datetime
+import os
+import struct
+import sys
+import threading
+import time
+
+try:
+    import numpy
+except ImportError:
+    # only the replay side needs numpy, recording runs without it
+    numpy = None
+
+TELEMETRY_DIR   = "telemetry"
+TELEMETRY_KEEP  = 30  # days of files kept
+TELEMETRY_FLUSH = 1.0 # seconds between flushes, readers see records this late
+
+MAGIC   = "NSTELEM1"
+VERSION = 1
+# magic, version, record size, time the file was created, station name
+HEADER      = struct.Struct("<8sIId32s8x")
+HEADER_SIZE = HEADER.size
+# time, satellite, commanded az/el, read-back az/el, range rate, tuned
+# frequency, az and el rotor codes, flags, antenna
+RECORD      = struct.Struct("<d24sfffffqbbBB")
+RECORD_SIZE = RECORD.size
+
+ENGAGED   = 1 # flags
+IN_RANGE  = 2
+CONNECTED = 4
+
+CODE_NONE    = -128
+CODE_TIMEOUT = 127
+
+if numpy is not None:
+    DTYPE = numpy.dtype([("time", "<f8"), ("sat", "S24"),
+                         ("cmd_az", "<f4"), ("cmd_el", "<f4"),
+                         ("az", "<f4"), ("el", "<f4"),
+                         ("range_rate", "<f4"), ("frequency", "<i8"),
+                         ("az_code", "i1"), ("el_code", "i1"),
+                         ("flags", "u1"), ("antenna", "u1")])
+    assert DTYPE.itemsize == RECORD_SIZE
+
+def dayFile(directory, date):
+    '''Path of the file holding records for unix time date'''
+    day = datetime.datetime.utcfromtimestamp(date).strftime("%Y%m%d")
+    return os.path.join(directory, "telemetry-%s.bin" % day)
+
+def _float(value):
+    return float("nan") if value is None else value
+
+def _name(sat):
+    # names from the JSON control socket are unicode
+    if not sat:
+        return ""
+    if isinstance(sat, unicode):
+        return sat.encode("ascii", "replace")
+    return sat
+
+def _code(code):
+    return CODE_TIMEOUT if code is None else max(min(code, 126), -127)
+
+################################################################################
+class TelemetryLog(object):
+    '''Appends records to the day file of their timestamp, switching files
+       at UTC midnight. Writes are buffered and flushed every flush
+       seconds, so a record costs no syscall of its own.
+    '''
+    def __init__(self, directory=TELEMETRY_DIR, station="",
+                 keep=TELEMETRY_KEEP, flush=TELEMETRY_FLUSH):
+        self.directory = directory
+        self.station   = station
+        self.keep      = keep
+        self.flush     = flush
+        self.path      = None
+        self.records   = 0
+        self._file     = None
+        self._flushed  = 0
+        self._lock     = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def record(self, date, sat, cmd_az, cmd_el, az, el, range_rate,
+               frequency, az_code, el_code, flags, antenna=0):
+        '''Appends one record. Unknown angles and range rate may be None,
+           as may a code for a command that got no reply.
+        '''
+        data = RECORD.pack(date, _name(sat), _float(cmd_az), _float(cmd_el),
+                           _float(az), _float(el), _float(range_rate),
+                           frequency or 0, _code(az_code), _code(el_code),
+                           flags, antenna)
+        with self._lock:
+            path = dayFile(self.directory, date)
+            if path != self.path:
+                self._open(path, date)
+            self._file.write(data)
+            self.records += 1
+            if date - self._flushed >= self.flush:
+                self._file.flush()
+                self._flushed = date
+
+    def _open(self, path, date):
+        self._close()
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if size < HEADER_SIZE:
+            f = open(path, "wb")
+            f.write(HEADER.pack(MAGIC, VERSION, RECORD_SIZE, time.time(),
+                                self.station))
+        else:
+            f = open(path, "r+b")
+            # a record cut short by a crash would shift every later one
+            f.truncate(size - (size - HEADER_SIZE) % RECORD_SIZE)
+            f.seek(0, os.SEEK_END)
+        self._file = f
+        self.path  = path
+        self._prune(date)
+
+    def _prune(self, date):
+        # from the record's date, which a simulated clock may set far back
+        cutoff = dayFile(self.directory, date - self.keep * 86400)
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if (name.startswith("telemetry-") and name.endswith(".bin") and
+                    path < cutoff):
+                os.unlink(path)
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+        self.path  = None
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+################################################################################
+def load(path):
+    '''Maps a telemetry file read-only as a NumPy array of DTYPE records'''
+    if numpy is None:
+        raise ImportError("telemetry replay requires numpy")
+    with open(path, "rb") as f:
+        header = f.read(HEADER_SIZE)
+    if len(header) < HEADER_SIZE:
+        raise ValueError("%s: not a telemetry file" % path)
+    magic, version, size, created, station = HEADER.unpack(header)
+    if magic != MAGIC or size != RECORD_SIZE:
+        raise ValueError("%s: not a version %d telemetry file" % (path, VERSION))
+    count = (os.path.getsize(path) - HEADER_SIZE) // RECORD_SIZE
+    if count == 0:
+        return numpy.zeros(0, DTYPE)
+    return numpy.memmap(path, DTYPE, "r", HEADER_SIZE, (count,))
+
+def separation(az1, el1, az2, el2):
+    '''Angle in degrees between az/el directions, elementwise. Works for
+       flipped pointings with el above 90 too.
+    '''
+    az1, el1, az2, el2 = [numpy.radians(numpy.asarray(a, dtype=float))
+                          for a in (az1, el1, az2, el2)]
+    c = (numpy.sin(el1) * numpy.sin(el2) +
+         numpy.cos(el1) * numpy.cos(el2) * numpy.cos(az1 - az2))
+    return numpy.degrees(numpy.arccos(numpy.clip(c, -1.0, 1.0)))
+
+def passes(records):
+    '''Splits each antenna's records into runs with the same target in
+       range. Returns a list of (antenna, satellite, records) in time order.
+    '''
+    out = []
+    for antenna in numpy.unique(records["antenna"]):
+        ours = records[records["antenna"] == antenna]
+        in_range = (ours["flags"] & IN_RANGE) != 0
+        key = numpy.where(in_range, ours["sat"], "")
+        edges = numpy.flatnonzero(key[1:] != key[:-1]) + 1
+        for run in numpy.split(numpy.arange(len(ours)), edges):
+            if len(run) and key[run[0]]:
+                out.append((int(antenna), key[run[0]],
+                            ours[run[0]:run[-1] + 1]))
+    out.sort(key=lambda p: p[2]["time"][0])
+    return out
+
+def summary(sat, records):
+    '''Pointing error between commanded and read-back directions, rotor
+       errors and tuning range over one pass
+    '''
+    err = separation(records["cmd_az"], records["cmd_el"], records["az"],
+                     records["el"])
+    err = err[~numpy.isnan(err)]
+    freq = records["frequency"][records["frequency"] > 0]
+    codes = numpy.concatenate([records["az_code"], records["el_code"]])
+    return {"sat": sat, "start": records["time"][0],
+            "end": records["time"][-1], "samples": len(records),
+            "engaged": float(numpy.mean((records["flags"] & ENGAGED) > 0)),
+            "err_rms": float(numpy.sqrt(numpy.mean(err ** 2))) if len(err) else None,
+            "err_max": float(err.max()) if len(err) else None,
+            "rotor_errors": int(numpy.sum((codes != 0) & (codes != CODE_NONE))),
+            "freq_min": int(freq.min()) if len(freq) else None,
+            "freq_max": int(freq.max()) if len(freq) else None}
+
+################################################################################
+def _utc(t):
+    return datetime.datetime.utcfromtimestamp(t).strftime("%H:%M:%S")
+
+def _opt(fmt, value):
+    return "-" if value is None else fmt % value
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Summarize or dump tracker telemetry")
+    parser.add_argument("file", nargs="?", help="telemetry file, default the "
+                        "one for --day")
+    parser.add_argument("--dir", default=TELEMETRY_DIR)
+    parser.add_argument("--day", help="YYYYMMDD (UTC), default today")
+    parser.add_argument("--sat", help="only records for this satellite")
+    parser.add_argument("--antenna", type=int,
+                        help="only records for this antenna set, 0 the main")
+    parser.add_argument("--csv", action="store_true",
+                        help="dump every record instead of pass summaries")
+    args = parser.parse_args()
+
+    path = args.file
+    if path is None:
+        date = time.time()
+        if args.day:
+            date = (datetime.datetime.strptime(args.day, "%Y%m%d") -
+                    datetime.datetime(1970, 1, 1)).total_seconds()
+        path = dayFile(args.dir, date)
+    began = time.time()
+    records = load(path)
+    if args.sat:
+        records = records[records["sat"] == args.sat]
+    if args.antenna is not None:
+        records = records[records["antenna"] == args.antenna]
+    if args.csv:
+        out = sys.stdout
+        out.write(",".join(DTYPE.names) + "\n")
+        for r in records:
+            out.write("%.3f,%s,%.2f,%.2f,%.2f,%.2f,%.4f,%d,%d,%d,%d,%d\n"
+                      % tuple(r))
+        return
+    print("%s: %d records in %.3f s" % (path, len(records),
+                                        time.time() - began))
+    print("%3s %-24s %-8s %-8s %7s %7s %8s %8s %6s %21s"
+          % ("ANT", "SATELLITE", "START", "END", "SAMPLES", "ENGAGED", "ERR RMS",
+             "ERR MAX", "ROTOR", "FREQUENCY (Hz)"))
+    for antenna, sat, run in passes(records):
+        s = summary(sat, run)
+        print("%3d %-24s %-8s %-8s %7d %6.0f%% %8s %8s %6d %10s-%-10s"
+              % (antenna, sat, _utc(s["start"]), _utc(s["end"]), s["samples"],
+                 100 * s["engaged"], _opt("%.3f", s["err_rms"]),
+                 _opt("%.3f", s["err_max"]), s["rotor_errors"],
+                 _opt("%d", s["freq_min"]), _opt("%d", s["freq_max"])))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+# test_telemetry.py: checks for the telemetry log
+# Written for UCLA's ELFIN mission <elfin.igpp.ucla.edu>
+#
+#   python -m unittest test_telemetry
+
+import shutil
+import tempfile
+import time
+import unittest
+
+import telemetry
+
+class TelemetryLogTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testUnicodeName(self):
+        '''Names added over the control socket arrive as unicode'''
+        now = time.time()
+        log = telemetry.TelemetryLog(self.directory)
+        log.record(now, u"FIREBIRD 4", 10.0, 20.0, None, None, 1.5,
+                   437219000, 0, 0, telemetry.IN_RANGE)
+        log.close()
+        if telemetry.numpy is None:
+            return
+        records = telemetry.load(telemetry.dayFile(self.directory, now))
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records["sat"][0], "FIREBIRD 4")
+
+if __name__ == "__main__":
+    unittest.main()